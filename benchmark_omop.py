@@ -0,0 +1,42 @@
+import argparse
+import sys
+
+from src.benchmark import run_benchmark, compare, save_results, load_results, format_results
+
+# python benchmark_omop.py --sizes 1000 10000 100000 --output bench.json
+# python benchmark_omop.py --compare bench.json  (exits 1 if any stage is slower than the baseline)
+
+parser = argparse.ArgumentParser(description="Benchmark the OMOP table generators and export across cohort sizes")
+parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="cohort sizes (persons)")
+parser.add_argument('--visits-per-person', type=int, default=5)
+parser.add_argument('--repeats', type=int, default=1, help="runs per size, the fastest is kept")
+parser.add_argument('--seed', type=int, default=42)
+parser.add_argument('--format', default='csv', help="export format to benchmark (csv, parquet, duckdb)")
+parser.add_argument('--tracemalloc', action='store_true', help="track per-stage peak allocations (slows pandas-heavy stages)")
+parser.add_argument('--output', default='benchmark_results.json', help="results file (JSON)")
+parser.add_argument('--compare', metavar='BASELINE', help="baseline results file to compare against")
+parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown vs baseline (0.2 = 20%%)")
+args = parser.parse_args()
+
+results = run_benchmark(
+    args.sizes,
+    visits_per_person=args.visits_per_person,
+    repeats=args.repeats,
+    seed=args.seed,
+    output_format=args.format,
+    trace_memory=args.tracemalloc
+)
+print(format_results(results))
+save_results(results, args.output)
+print(f"results written to {args.output}")
+
+if args.compare:
+    regressions = compare(results, load_results(args.compare), args.tolerance)
+    for r in regressions:
+        print(
+            f"REGRESSION {r['stage']} at {r['n_persons']} persons: "
+            f"{r['seconds']:.3f}s vs {r['baseline_seconds']:.3f}s baseline ({r['ratio']:.2f}x)"
+        )
+    if regressions:
+        sys.exit(1)
+    print("no regressions against baseline.")
@@ -1,93 +1,228 @@
-from src.datagen import generate_person_ids, generate_person_table, generate_visit_table, generate_condition_table, generate_measurement_table, generate_drug_exposure_table
-import pandas as pd
+import argparse
 
+from src.planner import PRESETS
+from src.schema import TABLE_COLUMNS
+
+# python create_synthetic_omop.py                            (defaults below, CSV in export/)
+# python create_synthetic_omop.py --persons 1000000 --visits 10000000 --format parquet --workers 8
+# python create_synthetic_omop.py --persons 100 --visits 500 --tables visit_occurrence --dir fixture
+# python create_synthetic_omop.py --append --persons 1000 --visits 20000
+# python create_synthetic_omop.py --resume
+# python create_synthetic_omop.py --preset load-test --format parquet --dry-run   (print the plan only)
+# pandas and the generators are imported after argument parsing, so --help starts instantly
+
+# defaults, each can be overridden on the command line
+# --preset sets persons and visits from a named size (dev, ci, load-test, 100m)
 n_persons = 10000
 n_visits = 50000
 
-# person
-person_ids = generate_person_ids(n_persons)
-person_df = generate_person_table(person_ids)
-print("persons generated...")
+# persons per shard, peak memory scales with this rather than n_persons
+# None lets the planner size shards from the cohort (about 5M rows per shard)
+shard_size = None
 
-# visit_occurrence
-visit_df = generate_visit_table(person_ids, n_visits)
-print("visits generated...")
+# master seed, output is identical for a given seed and shard_size whatever the number of workers
+# set seed = None for a different dataset each run
+seed = 42
+# None lets the planner use as many workers as cores, shards and memory allow,
+# resumed runs default to the workers of the interrupted run
+workers = None
+# memory the planner may plan for in MB, None for 80% of the available memory
+memory_limit_mb = None
 
-# condition_occurrence
-condition_df = generate_condition_table(person_ids, visit_df)
-print("conditions generated...")
+# concept distributions (demographics, visit types, condition/drug clusters, measurements)
+# JSON or YAML (needs pyyaml), see definitions/concepts.json for the format, None for the default
+definitions_path = None
 
-# drug_exposure
-drug_df = generate_drug_exposure_table(person_ids, visit_df)
-print("drugs generated...")
+# tables to generate, None for all, tables they reference are always included
+# e.g. ['visit_occurrence'] generates person and visit_occurrence only and skips the event generators
+tables = None
 
-# measurement
-measurement_df = generate_measurement_table(person_ids, visit_df)
-print("measurements generated...")
+# output directory and format, 'csv', 'parquet' (needs pyarrow) or 'duckdb' (needs duckdb and pyarrow)
+# the format and options are recorded in the manifest, resumed and appending runs keep those of the dataset
+# csv options: n_parts (part files per table written in parallel), compression ('gzip' or 'zstd'),
+# compression_level (default 1), threads
+# parquet options: compression, row_group_size, partition_by ('year' or 'person_bucket'), n_buckets
+# duckdb options: database (file name in the output directory, default omop.duckdb)
+output_dir = 'export'
+output_format = 'csv'
+output_options = {}
 
-# export
-print("exporting OMOP tables...")
+# append = True extends the dataset recorded in <output_dir>/manifest.json instead of regenerating it,
+# adding n_persons new persons and n_visits new visits (spread over new and existing persons)
+# dated in the window_days after the previous run, with ids carrying on from the previous run
+append = False
+window_days = 365
 
-tables = {
-    'person': person_df,
-    'visit_occurrence': visit_df,
-    'condition_occurrence': condition_df,
-    'drug_exposure': drug_df,
-    'measurement': measurement_df
-}
+# runs are checkpointed in <output_dir>/manifest.json after every shard, resume = True finishes an interrupted
+# run (full or append) from its last checkpoint, with output identical to an uninterrupted run
+resume = False
+
+# structured JSON run report with per-stage timings, rows/sec and peak memory
+report_path = 'run_report.json'
+# seconds between progress lines
+progress_interval = 10.0
+# per-stage profiles written to profiles/, None, 'cprofile' or 'pyinstrument' (needs pyinstrument)
+profile = None
 
-# reordering and checking for column existence
-# can replace with dataclasses
-TABLE_COLUMNS = {
-    'person': [
-        'person_id', 'gender_concept_id', 'year_of_birth', 'month_of_birth',
-        'day_of_birth', 'birth_datetime', 'race_concept_id', 'ethnicity_concept_id',
-        'location_id', 'provider_id', 'care_site_id', 'person_source_value',
-        'gender_source_value', 'gender_source_concept_id', 'race_source_value',
-        'race_source_concept_id', 'ethnicity_source_value', 'ethnicity_source_concept_id'
-    ],
-    
-    'visit_occurrence': [
-        'visit_occurrence_id', 'person_id', 'visit_concept_id', 'visit_start_date',
-        'visit_start_datetime', 'visit_end_date', 'visit_end_datetime', 'visit_type_concept_id',
-        'provider_id', 'care_site_id', 'visit_source_value', 'visit_source_concept_id',
-        'admitted_from_concept_id', 'admitted_from_source_value', 'discharged_to_concept_id',
-        'discharged_to_source_value', 'preceding_visit_occurrence_id'
-    ],
-    
-    'condition_occurrence': [
-        'condition_occurrence_id', 'person_id', 'condition_concept_id', 'condition_start_date',
-        'condition_start_datetime', 'condition_end_date', 'condition_end_datetime',
-        'condition_type_concept_id', 'condition_status_concept_id', 'stop_reason',
-        'provider_id', 'visit_occurrence_id', 'visit_detail_id', 'condition_source_value',
-        'condition_source_concept_id', 'condition_status_source_value'
-    ],
-    
-    'drug_exposure': [
-        'drug_exposure_id', 'person_id', 'drug_concept_id', 'drug_exposure_start_date',
-        'drug_exposure_start_datetime', 'drug_exposure_end_date', 'drug_exposure_end_datetime',
-        'verbatim_end_date', 'drug_type_concept_id', 'stop_reason', 'refills', 'quantity',
-        'days_supply', 'sig', 'route_concept_id', 'lot_number', 'provider_id',
-        'visit_occurrence_id', 'visit_detail_id', 'drug_source_value',
-        'drug_source_concept_id', 'route_source_value', 'dose_unit_source_value'
-    ],
-    
-    'measurement': [
-        'measurement_id', 'person_id', 'measurement_concept_id', 'measurement_date',
-        'measurement_datetime', 'measurement_time', 'measurement_type_concept_id',
-        'operator_concept_id', 'value_as_number', 'value_as_concept_id', 'unit_concept_id',
-        'range_low', 'range_high', 'provider_id', 'visit_occurrence_id', 'visit_detail_id',
-        'measurement_source_value', 'measurement_source_concept_id', 'unit_source_value',
-        'unit_source_concept_id', 'value_source_value', 'measurement_event_id',
-        'meas_event_field_concept_id'
-    ]
+# formats each sink option applies to, checked before anything is imported
+FORMAT_OPTIONS = {
+    'parts': ('csv',),
+    'compression': ('csv', 'parquet')
 }
+CSV_COMPRESSIONS = ('gzip', 'zstd')
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic OMOP CDM 5.4 tables")
+    parser.add_argument('--preset', choices=list(PRESETS), help="named cohort size: " + ', '.join(
+        f"{name} ({size['n_persons']:,} persons, {size['n_visits']:,} visits)" for name, size in PRESETS.items()
+    ))
+    parser.add_argument('--persons', type=int, help=f"persons to generate (new persons with --append), default {n_persons}")
+    parser.add_argument('--visits', type=int, help=f"visits to generate (new visits with --append), default {n_visits}")
+    parser.add_argument('--seed', type=int, default=seed, help="master seed, output is reproducible for a given seed and shard size")
+    parser.add_argument('--dir', default=output_dir, help="output directory")
+    parser.add_argument('--format', choices=['csv', 'parquet', 'duckdb'], help=f"output format, default {output_format} (or as recorded for the dataset with --resume and --append)")
+    parser.add_argument('--workers', type=int, default=workers, help="worker processes generating shards, default chosen by the planner (or as planned for the interrupted run with --resume)")
+    parser.add_argument('--shard-size', type=int, default=shard_size, help="persons per shard, peak memory scales with this, default chosen by the planner")
+    parser.add_argument('--memory-limit', type=float, default=memory_limit_mb, help="memory in MB the planner may use, default 80%% of available memory")
+    parser.add_argument('--dry-run', action='store_true', help="print the run plan (rows, shards, workers, memory, time) without generating")
+    parser.add_argument('--tables', nargs='+', choices=list(TABLE_COLUMNS), default=tables, help="tables to generate (plus the tables they reference), default all")
+    parser.add_argument('--definitions', default=definitions_path, help="concept definitions file (JSON or YAML)")
+    parser.add_argument('--compression', help="csv: gzip or zstd, parquet: parquet codec (default zstd)")
+    parser.add_argument('--parts', type=int, help="csv: part files per table, written in parallel")
+    parser.add_argument('--append', action='store_true', default=append, help="extend the dataset recorded in <dir>/manifest.json")
+    parser.add_argument('--window-days', type=int, default=window_days, help="with --append, days of new visits after the previous run")
+    parser.add_argument('--resume', action='store_true', default=resume, help="finish an interrupted run from its last checkpoint")
+    parser.add_argument('--report', default=report_path, help="run report file (JSON)")
+    parser.add_argument('--progress-interval', type=float, default=progress_interval, help="seconds between progress lines")
+    parser.add_argument('--profile', default=profile, choices=['cprofile', 'pyinstrument'], help="write per-stage profiles to profiles/")
+    args = parser.parse_args(argv)
+
+    # resumed and appending runs without --format are checked against the recorded format in main
+    output = args.format or (None if args.resume or args.append else output_format)
+    if output is not None:
+        for option, formats in FORMAT_OPTIONS.items():
+            if getattr(args, option) is not None and output not in formats:
+                parser.error(f"--{option} is not supported with --format {output}")
+        if output == 'csv' and args.compression is not None and args.compression not in CSV_COMPRESSIONS:
+            parser.error(f"--compression for csv must be one of {', '.join(CSV_COMPRESSIONS)}")
+    if args.parts is not None and args.parts < 1:
+        parser.error("--parts must be at least 1")
+
+    # explicit --persons / --visits override the preset
+    size = PRESETS[args.preset] if args.preset else {'n_persons': n_persons, 'n_visits': n_visits}
+    if args.persons is None:
+        args.persons = size['n_persons']
+    if args.visits is None:
+        args.visits = size['n_visits']
+    return args
+
+def output_settings(args, manifest=None):
+    """
+    (format, sink options) of the run, those recorded in manifest when it has them
+    Raises ValueError if the command line asks for another format or options than recorded
+    """
+    from src.export import sink_options
+
+    options = {}
+    if args.compression:
+        options['compression'] = args.compression
+    if args.parts:
+        options['n_parts'] = args.parts
+    recorded = manifest.get('output') if manifest is not None else None
+    # manifests written before the output was recorded take it from the command line
+    if recorded is None:
+        output = args.format or output_format
+        return output, sink_options(output, {**output_options, **options})
+
+    if args.format is not None and args.format != recorded['format']:
+        raise ValueError(f"the dataset is written as {recorded['format']}, not {args.format}")
+    for key, value in sink_options(recorded['format'], options).items():
+        if key in options and value != recorded['options'].get(key):
+            raise ValueError(f"the dataset is written with {key}={recorded['options'].get(key)}, not {value}")
+    return recorded['format'], recorded['options']
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # deferred so --help does not pay for importing pandas and the generators
+    from src.concepts import DEFINITIONS_PATH, load_concept_model
+    from src.export import make_sink
+    from src.instrumentation import RunReport, print_progress
+    from src.manifest import load_manifest, manifest_path
+    from src.pipeline import run_pipeline, extend_pipeline, resume_pipeline, manifest_definitions_path
+    from src.planner import plan_run, format_plan
+
+    # resumed and appending runs write with the format and options recorded for the dataset
+    manifest = None
+    try:
+        if args.resume or args.append:
+            manifest = load_manifest(manifest_path(args.dir))
+        output, options = output_settings(args, manifest)
+    except (ValueError, FileNotFoundError) as e:
+        raise SystemExit(f"error: {e}")
+
+    # plan before creating the sink, which may clear previous output
+    # appending keeps the shard size and tables of the dataset and spreads visits over all its persons
+    plan = None
+    if not args.resume:
+        definitions = args.definitions or DEFINITIONS_PATH
+        plan_shard_size, plan_tables, cohort_persons, next_ids = args.shard_size, args.tables, args.persons, None
+        if args.append:
+            definitions = manifest_definitions_path(manifest)
+            plan_shard_size, plan_tables = manifest['shard_size'], manifest.get('tables')
+            cohort_persons = manifest['n_persons'] + args.persons
+            next_ids = manifest['next_ids']
+        plan = plan_run(
+            args.persons,
+            args.visits,
+            output,
+            load_concept_model(definitions),
+            plan_tables,
+            plan_shard_size,
+            args.workers,
+            args.memory_limit,
+            cohort_persons,
+            next_ids
+        )
+        print(format_plan(plan))
+    if args.dry_run:
+        return
+    # runs certain to fail part way are refused before any output is touched
+    if plan is not None and plan['errors']:
+        raise SystemExit("error: the run cannot finish, see the plan above")
+
+    # generate all tables shard by shard, appending each shard to the output directory
+    print("appending to OMOP tables..." if args.append else "generating OMOP tables...")
+    sink = make_sink(output, args.dir, append=args.append or args.resume, **options)
+    report = RunReport(progress=print_progress, progress_interval=args.progress_interval, profile=args.profile)
+    report.meta['plan'] = plan
+    if args.resume:
+        summary = resume_pipeline(manifest_path(args.dir), sink, args.workers, report)
+    elif args.append:
+        summary = extend_pipeline(manifest_path(args.dir), args.persons, args.visits, sink, plan['workers'], report, args.window_days)
+    else:
+        summary = run_pipeline(
+            args.persons,
+            args.visits,
+            sink,
+            plan['shard_size'],
+            args.seed,
+            plan['workers'],
+            report,
+            args.definitions or DEFINITIONS_PATH,
+            manifest_path(args.dir),
+            args.tables,
+            {'format': output, 'options': options}
+        )
+
+    for table_name, stats in summary['tables'].items():
+        print(f"{table_name}: {stats['rows']} rows, {stats['bytes_per_row']:.0f} bytes/row in memory")
+    for stage, stats in summary['stages'].items():
+        print(f"{stage}: {stats['seconds']:.2f}s, {stats['rows_per_sec'] or 0:,.0f} rows/sec")
 
-for table_name, df in tables.items():
-    df.to_csv(
-        f"export/{table_name}.csv",
-        index=False,
-        columns=TABLE_COLUMNS[table_name]
-    )
+    report.save(args.report)
+    print(f"OMOP tables exported, run report written to {args.report}.")
 
-print("OMOP tables exported.")
+# guard needed for the worker processes, which re-import this module on spawn-based platforms
+if __name__ == '__main__':
+    main()
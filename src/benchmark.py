@@ -0,0 +1,187 @@
+import json
+import math
+import platform
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from src.datagen import generate_person_ids, generate_person_table, generate_person_profiles, generate_visit_table, generate_condition_table, generate_measurement_table, generate_drug_exposure_table, build_person_visit_index
+from src.export import make_sink
+from src.instrumentation import peak_rss_mb
+
+"""
+Benchmark harness for the table generators and export step
+Runs every stage across a grid of cohort sizes, recording wall time, rows/sec and peak memory,
+and compares results against a stored baseline to catch regressions
+"""
+
+STAGES = ['person_profile', 'person', 'visit_occurrence', 'visit_index', 'condition_occurrence', 'drug_exposure', 'measurement', 'export']
+
+def run_stage(stage, func, trace_memory=False):
+    """
+    Time func(), which returns (result, rows), returning (result, stage record)
+    """
+    if trace_memory:
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    result, rows = func()
+    seconds = time.perf_counter() - start
+
+    return result, {
+        'stage': stage,
+        'seconds': seconds,
+        'rows': rows,
+        'rows_per_sec': rows / seconds if seconds > 0 else None,
+        'peak_tracemalloc_mb': tracemalloc.get_traced_memory()[1] / 1024 ** 2 if trace_memory else None,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+def benchmark_size(n_persons, n_visits, seed=42, output_format='csv', trace_memory=False):
+    """
+    Run every stage once for a cohort of n_persons / n_visits, returning one record per stage
+    peak_rss_mb is the process peak so far, trace_memory adds per-stage tracemalloc peaks
+    """
+    rng = np.random.default_rng(seed)
+    records = []
+    tables = {}
+
+    def stage(name, func):
+        result, record = run_stage(name, func, trace_memory)
+        record.update({'n_persons': n_persons, 'n_visits': n_visits})
+        records.append(record)
+        return result
+
+    person_ids = generate_person_ids(n_persons)
+    profiles = stage('person_profile', lambda: (generate_person_profiles(person_ids, rng), n_persons))
+    tables['person'] = stage('person', lambda: _with_rows(generate_person_table(person_ids, rng=rng, profiles=profiles)))
+    visit_df = stage('visit_occurrence', lambda: _with_rows(generate_visit_table(person_ids, n_visits, rng=rng, birth_years=profiles.year_of_birth)))
+    tables['visit_occurrence'] = visit_df
+    visit_index = stage('visit_index', lambda: (build_person_visit_index(person_ids, visit_df), n_visits))
+    tables['condition_occurrence'] = stage(
+        'condition_occurrence',
+        lambda: _with_rows(generate_condition_table(person_ids, visit_df, visit_index, rng=rng, profiles=profiles))
+    )
+    tables['drug_exposure'] = stage(
+        'drug_exposure',
+        lambda: _with_rows(generate_drug_exposure_table(person_ids, visit_df, visit_index, rng=rng, profiles=profiles))
+    )
+    tables['measurement'] = stage(
+        'measurement',
+        lambda: _with_rows(generate_measurement_table(person_ids, visit_df, visit_index, rng=rng))
+    )
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        stage('export', lambda: (_export(tables, output_format, output_dir), sum(len(df) for df in tables.values())))
+
+    return records
+
+def _with_rows(df):
+    return df, len(df)
+
+def _export(tables, output_format, output_dir):
+    sink = make_sink(output_format, output_dir)
+    for table_name, df in tables.items():
+        sink.write(table_name, df)
+    sink.close()
+
+def scaling_exponents(records):
+    """
+    Log-log slope of seconds against rows between the smallest and largest cohort per stage
+    ~1 means the stage scales linearly, ~2 quadratically
+    """
+    exponents = {}
+    for stage in STAGES:
+        points = sorted(
+            (r['rows'], r['seconds']) for r in records
+            if r['stage'] == stage and r['rows'] > 0 and r['seconds'] > 0
+        )
+        if len(points) >= 2 and points[-1][0] > points[0][0]:
+            (rows_small, secs_small), (rows_large, secs_large) = points[0], points[-1]
+            exponents[stage] = math.log(secs_large / secs_small) / math.log(rows_large / rows_small)
+    return exponents
+
+def run_benchmark(sizes, visits_per_person=5, repeats=1, seed=42, output_format='csv', trace_memory=False):
+    """
+    Benchmark every stage for each cohort size in sizes, keeping the fastest of repeats runs
+    Returns a results dict ready to be written as JSON
+    """
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        records = []
+        for n_persons in sizes:
+            n_visits = n_persons * visits_per_person
+            runs = [benchmark_size(n_persons, n_visits, seed, output_format, trace_memory) for _ in range(repeats)]
+            for stage_runs in zip(*runs):
+                records.append(min(stage_runs, key=lambda r: r['seconds']))
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+
+    return {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'seed': seed,
+            'repeats': repeats,
+            'output_format': output_format
+        },
+        'results': records,
+        'scaling_exponents': scaling_exponents(records)
+    }
+
+def compare(results, baseline, tolerance=0.2, min_seconds=0.05):
+    """
+    Compare stage timings with a baseline results dict
+    Returns list of regressions where seconds grew by more than tolerance (0.2 = 20% slower)
+    stages faster than min_seconds in the baseline are skipped as too noisy to compare
+    """
+    baseline_seconds = {
+        (r['n_persons'], r['stage']): r['seconds'] for r in baseline['results']
+    }
+    regressions = []
+    for r in results['results']:
+        key = (r['n_persons'], r['stage'])
+        if key not in baseline_seconds or baseline_seconds[key] < min_seconds:
+            continue
+        ratio = r['seconds'] / baseline_seconds[key]
+        if ratio > 1 + tolerance:
+            regressions.append({
+                'n_persons': r['n_persons'],
+                'stage': r['stage'],
+                'seconds': r['seconds'],
+                'baseline_seconds': baseline_seconds[key],
+                'ratio': ratio
+            })
+    return regressions
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+def format_results(results):
+    """
+    Plain text table of results, one line per cohort size and stage
+    """
+    lines = [f"{'persons':>10} {'stage':<22} {'seconds':>9} {'rows':>11} {'rows/sec':>12} {'peak MB':>9} {'rss MB':>9}"]
+    for r in results['results']:
+        rows_per_sec = f"{r['rows_per_sec']:,.0f}" if r['rows_per_sec'] else '-'
+        peak = f"{r['peak_tracemalloc_mb']:.1f}" if r['peak_tracemalloc_mb'] is not None else '-'
+        rss = f"{r['peak_rss_mb']:.1f}" if r['peak_rss_mb'] is not None else '-'
+        lines.append(
+            f"{r['n_persons']:>10} {r['stage']:<22} {r['seconds']:>9.3f} {r['rows']:>11} {rows_per_sec:>12} {peak:>9} {rss:>9}"
+        )
+    for stage, exponent in results['scaling_exponents'].items():
+        lines.append(f"scaling {stage}: time ~ rows^{exponent:.2f}")
+    return '\n'.join(lines)
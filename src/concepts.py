@@ -0,0 +1,234 @@
+import json
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+
+import numpy as np
+
+"""
+Concept distributions loaded from a definitions file (definitions/concepts.json by default)
+The file is validated and compiled once per process into NumPy arrays with alias tables, so every
+generator shares one model and each categorical draw is O(1) however many concepts a distribution has
+"""
+
+DEFINITIONS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'definitions', 'concepts.json')
+
+@dataclass
+class Categorical:
+    """
+    Compiled categorical distribution over values (concept ids or cluster indices)
+    alias / alias_probability are the Walker alias table, cumulative the cumulative probabilities
+    """
+    values: np.ndarray
+    probabilities: np.ndarray
+    cumulative: np.ndarray
+    alias: np.ndarray
+    alias_probability: np.ndarray
+
+    def sample(self, rng, size):
+        """
+        Draw size values in one batch, one uniform per draw via the alias table
+        """
+        n = len(self.values)
+        scaled = rng.random(size) * n
+        column = scaled.astype(np.int64)
+        keep = (scaled - column) < self.alias_probability[column]
+        return self.values[np.where(keep, column, self.alias[column])]
+
+def compile_categorical(values, probabilities, name='distribution'):
+    """
+    Validate probabilities and build the alias table (Vose's method)
+    """
+    values = np.asarray(values)
+    probabilities = np.asarray(probabilities, dtype=float)
+    if len(values) == 0 or len(values) != len(probabilities):
+        raise ValueError(f"{name}: needs one probability per value")
+    if (probabilities < 0).any() or not np.isclose(probabilities.sum(), 1.0, atol=1e-6):
+        raise ValueError(f"{name}: probabilities must be non-negative and sum to 1, got {probabilities.sum():.6f}")
+    probabilities = probabilities / probabilities.sum()
+
+    n = len(values)
+    scaled = probabilities * n
+    alias = np.arange(n)
+    alias_probability = np.ones(n)
+    small = [i for i in range(n) if scaled[i] < 1.0]
+    large = [i for i in range(n) if scaled[i] >= 1.0]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        alias_probability[s] = scaled[s]
+        alias[s] = l
+        scaled[l] = scaled[l] + scaled[s] - 1.0
+        (small if scaled[l] < 1.0 else large).append(l)
+
+    return Categorical(
+        values=values,
+        probabilities=probabilities,
+        cumulative=np.cumsum(probabilities),
+        alias=alias,
+        alias_probability=alias_probability
+    )
+
+def compile_concepts(entries, name):
+    """
+    Compile a list of {"concept_id", "p"} entries
+    """
+    try:
+        concept_ids = [int(entry['concept_id']) for entry in entries]
+        probabilities = [float(entry['p']) for entry in entries]
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f"{name}: entries need an integer concept_id and a probability p")
+    if len(set(concept_ids)) != len(concept_ids):
+        raise ValueError(f"{name}: duplicate concept_id")
+    return compile_categorical(np.array(concept_ids, dtype=np.int64), probabilities, name)
+
+# parameters each distribution needs, see datagen.draw_length_of_stay and datagen.draw_visit_counts
+LENGTH_OF_STAY_PARAMETERS = {
+    'fixed': ('days',),
+    'uniform': ('low', 'high'),
+    'geometric': ('p',),
+    'lognormal': ('mean', 'sigma')
+}
+VISITS_PER_PERSON_PARAMETERS = {
+    'uniform': (),
+    'lognormal': ('sigma',),
+    'gamma': ('shape',),
+    'pareto': ('alpha',)
+}
+AGE_KEYS = ('min', 'max', 'alpha', 'beta')
+MEASUREMENT_KEYS = ('concept_id', 'unit_concept_id', 'mean', 'std', 'probability')
+
+def check_distribution(spec, parameters, name):
+    """
+    Check spec is a dict naming a distribution of parameters with all the parameters it needs
+    """
+    if not isinstance(spec, dict) or spec.get('distribution') not in parameters:
+        distribution = spec.get('distribution') if isinstance(spec, dict) else spec
+        raise ValueError(f"{name}: unknown distribution {distribution}, expected one of {list(parameters)}")
+    missing = [key for key in parameters[spec['distribution']] if key not in spec]
+    if missing:
+        raise ValueError(f"{name}: {spec['distribution']} distribution missing parameters {missing}")
+
+def check_keys(entry, keys, name):
+    """
+    Check entry is a dict with all of keys
+    """
+    missing = [key for key in keys if not isinstance(entry, dict) or key not in entry]
+    if missing:
+        raise ValueError(f"{name}: missing keys {missing}")
+
+@dataclass
+class ConceptModel:
+    """
+    All concept distributions used by the generators, compiled from a definitions file
+    cluster k of cluster_names has conditions condition_clusters[k] and drugs drug_clusters[k]
+    """
+    gender: Categorical
+    race: Categorical
+    ethnicity: Categorical
+    age: dict
+    visit_types: Categorical
+    length_of_stay: dict
+    visits_per_person: dict
+    cluster_names: list
+    cluster_distribution: Categorical
+    condition_clusters: list
+    drug_clusters: list
+    measurement_concept_ids: np.ndarray
+    measurement_unit_concept_ids: np.ndarray
+    measurement_means: np.ndarray
+    measurement_stds: np.ndarray
+    measurement_probabilities: np.ndarray
+
+def compile_definitions(definitions):
+    """
+    Validate a definitions dict (see definitions/concepts.json) and compile it into a ConceptModel
+    """
+    required = [
+        'gender', 'race', 'ethnicity', 'age', 'visit_types', 'length_of_stay', 'cluster_distribution',
+        'condition_clusters', 'drug_clusters', 'measurements'
+    ]
+    missing = [key for key in required if key not in definitions]
+    if missing:
+        raise ValueError(f"definitions missing sections: {missing}")
+
+    # optional, files written before it was added keep a moderately skewed default
+    visits_per_person = definitions.get('visits_per_person', {'distribution': 'lognormal', 'sigma': 1.0})
+    check_distribution(visits_per_person, VISITS_PER_PERSON_PARAMETERS, 'visits_per_person')
+
+    length_of_stay = {}
+    for concept_id, spec in definitions['length_of_stay'].items():
+        try:
+            length_of_stay[int(concept_id)] = spec
+        except ValueError:
+            raise ValueError(f"length_of_stay: keys must be visit concept ids, got {concept_id}")
+        check_distribution(spec, LENGTH_OF_STAY_PARAMETERS, f"length_of_stay {concept_id}")
+
+    age = definitions['age']
+    check_keys(age, AGE_KEYS, 'age')
+    if not (0 <= age['min'] < age['max'] and age['alpha'] > 0 and age['beta'] > 0):
+        raise ValueError("age: needs 0 <= min < max and positive alpha and beta")
+
+    # clusters are matched by name, condition and drug clusters must cover the same names
+    # a person's drugs are drawn from the drug cluster of the same name as their condition cluster
+    cluster_names = list(definitions['cluster_distribution'])
+    for section in ('condition_clusters', 'drug_clusters'):
+        if set(definitions[section]) != set(cluster_names):
+            raise ValueError(f"{section}: cluster names must match cluster_distribution")
+
+    measurements = definitions['measurements']
+    for m in measurements:
+        check_keys(m, MEASUREMENT_KEYS, f"measurements {m.get('name') if isinstance(m, dict) else m}")
+        if not 0 <= m['probability'] <= 1 or m['std'] < 0:
+            raise ValueError(f"measurements {m.get('name')}: needs 0 <= probability <= 1 and std >= 0")
+
+    return ConceptModel(
+        gender=compile_concepts(definitions['gender'], 'gender'),
+        race=compile_concepts(definitions['race'], 'race'),
+        ethnicity=compile_concepts(definitions['ethnicity'], 'ethnicity'),
+        age={key: age[key] for key in AGE_KEYS},
+        visit_types=compile_concepts(definitions['visit_types'], 'visit_types'),
+        length_of_stay=length_of_stay,
+        visits_per_person={key: value for key, value in visits_per_person.items() if key != 'note'},
+        cluster_names=cluster_names,
+        cluster_distribution=compile_categorical(
+            np.arange(len(cluster_names)),
+            [definitions['cluster_distribution'][name] for name in cluster_names],
+            'cluster_distribution'
+        ),
+        condition_clusters=[
+            compile_concepts(definitions['condition_clusters'][name], f"condition_clusters {name}")
+            for name in cluster_names
+        ],
+        drug_clusters=[
+            compile_concepts(definitions['drug_clusters'][name], f"drug_clusters {name}")
+            for name in cluster_names
+        ],
+        measurement_concept_ids=np.array([m['concept_id'] for m in measurements], dtype=np.int64),
+        measurement_unit_concept_ids=np.array([m['unit_concept_id'] for m in measurements], dtype=np.int64),
+        measurement_means=np.array([m['mean'] for m in measurements], dtype=float),
+        measurement_stds=np.array([m['std'] for m in measurements], dtype=float),
+        measurement_probabilities=np.array([m['probability'] for m in measurements], dtype=float)
+    )
+
+def read_definitions(path):
+    """
+    Read a definitions file, JSON or YAML (.yaml / .yml, needs pyyaml)
+    """
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("pyyaml is required for YAML definitions: pip install pyyaml")
+            return yaml.safe_load(f)
+        return json.load(f)
+
+@lru_cache(maxsize=None)
+def load_concept_model(path=DEFINITIONS_PATH):
+    """
+    Load and compile a definitions file, cached so each process compiles it once
+    """
+    try:
+        return compile_definitions(read_definitions(path))
+    except ValueError as e:
+        raise ValueError(f"{path}: {e}")
@@ -1,7 +1,10 @@
 import pandas as pd
 import numpy as np
+from dataclasses import dataclass
 from datetime import datetime
-from scipy import stats
+
+from src.concepts import load_concept_model
+from src.schema import apply_schema
 
 """
 Functions to generate synthetic data for core OMOP CDM 5.4 Tables
@@ -10,444 +13,415 @@ Functions to generate synthetic data for core OMOP CDM 5.4 Tables
 Some basic clinical sense is maintained, although dataset generation does not aim to preserve true-to-life distributions
 """
 
-def generate_person_ids(n):
+def default_rng(rng=None):
+    """
+    Return rng if given, else a freshly seeded numpy Generator
+    every generator takes an rng so runs are reproducible and shards (or threads) can each own their own stream
+    all draws are batched Generator calls (beta, normal, integers, alias table categoricals), any bit
+    generator works, e.g. np.random.Generator(np.random.Philox(seed))
+    """
+    return rng if rng is not None else np.random.default_rng()
+
+def generate_person_ids(n, start_id=1000000000):
     """
     Generate list of unique person_id where n = no of patients in dataset
+    start_id lets shards of a larger cohort continue the id sequence
+    """
+    return list(range(start_id, n + start_id))
+
+@dataclass
+class PersonVisitIndex:
+    """
+    CSR style index of visits grouped by person
+    visits of person i are at positions offsets[i]:offsets[i + 1] of the sorted arrays
     """
-    return list(range(1000000000, n + 1000000000))
+    person_ids: np.ndarray
+    offsets: np.ndarray
+    visit_occurrence_id: np.ndarray
+    visit_start_date: np.ndarray
 
-def generate_person_table(person_ids):
+def build_person_visit_index(person_ids, visit_df):
+    """
+    Build person -> visits index once from generate_visit_table output, shared by downstream generators
+    """
+    person_ids = np.asarray(person_ids)
+
+    # position of each visit's person in person_ids
+    person_pos = pd.Index(person_ids).get_indexer(visit_df['person_id'])
+    if (person_pos < 0).any():
+        raise ValueError("visit_df contains person_id not present in person_ids")
+
+    # stable sort keeps visits in their original order within each person
+    order = np.argsort(person_pos, kind='stable')
+    counts = np.bincount(person_pos, minlength=len(person_ids))
+    offsets = np.zeros(len(person_ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    return PersonVisitIndex(
+        person_ids=person_ids,
+        offsets=offsets,
+        visit_occurrence_id=visit_df['visit_occurrence_id'].to_numpy()[order],
+        visit_start_date=visit_df['visit_start_date'].to_numpy()[order]
+    )
+
+@dataclass
+class PersonProfiles:
+    """
+    Latent person level attributes, one entry per person in person_ids order (the visit index order)
+    cluster is the person's disease cluster, an index into concepts.cluster_names
+    year_of_birth is shared by the person table and the visit timelines
+    """
+    person_ids: np.ndarray
+    cluster: np.ndarray
+    year_of_birth: np.ndarray
+
+def generate_person_profiles(person_ids, rng=None, concepts=None, reference_year=None):
+    """
+    Draw the latent profile of every person once, in one vectorized pass
+    downstream generators read the same profiles so a person's drugs match their conditions
+    ages are relative to reference_year (default the current year), fix it to redraw the same profiles later
+    """
+    rng = default_rng(rng)
+    concepts = concepts or load_concept_model()
+    person_ids = np.asarray(person_ids)
+    n = len(person_ids)
+    if reference_year is None:
+        reference_year = datetime.now().year
+
+    # for simplicity, each person only gets assigned a single disease cluster
+    # smallest integer type holding every cluster index, int8 would wrap past 127 clusters
+    cluster = concepts.cluster_distribution.sample(rng, n).astype(np.min_scalar_type(len(concepts.cluster_names) - 1))
+
+    # generate age dist with left skew (more elderly), parameters in the definitions file
+    age = concepts.age
+    age_dist = rng.beta(age['alpha'], age['beta'], n) # distribution from 0 to 1
+    ages = age_dist * (age['max'] - age['min']) + age['min'] # standardise
+    year_of_birth = reference_year - ages.astype(int)
+
+    return PersonProfiles(person_ids=person_ids, cluster=cluster, year_of_birth=year_of_birth)
+
+def generate_person_table(person_ids, rng=None, concepts=None, profiles=None):
     """
     Generate OMOP person table
+    concepts is the compiled ConceptModel, defaults to definitions/concepts.json
+    profiles (from generate_person_profiles) supply the year of birth, drawn here if not given
     """
+    rng = default_rng(rng)
+    concepts = concepts or load_concept_model()
     n = len(person_ids)
-    current_year = datetime.now().year
+    if profiles is None:
+        profiles = generate_person_profiles(person_ids, rng, concepts)
 
-    # define distributions for each demographic
-    gender_dist = {
-        8507: 0.5,  # M | MALE
-        8532: 0.5   # F | FEMALE
-    }
-    race_dist = {
-        8527: 0.70,     # 5 | White
-        8516: 0.10,     # 3 | Black of African American
-        8515: 0.10,     # 2 | Asian
-        38003579: 0.10	# 2.06 | Chinese
-    }
-    ethnicity_dist = {
-        38003564: 1.0,    # Not Hispanic
-        38003563: 0.0     # Hispanic
-    }
-    
-    # generate age dist with left skew (more elderly)
-    # test skew here: https://homepage.divms.uiowa.edu/~mbognar/applets/beta.html
-    age_range = (18, 88)
-    alpha, beta = 6, 2
-    age_dist = stats.beta.rvs(alpha, beta, size=n) # distribution from 0 to 1
-    ages = age_dist * (age_range[1] - age_range[0]) + age_range[0] # standardise
-    birth_years = current_year - ages.astype(int)
-    
     # create omop.person dataframe
     df = pd.DataFrame({
         'person_id': person_ids,
-        'gender_concept_id': np.random.choice( 
-            list(gender_dist.keys()),
-            n,
-            p=list(gender_dist.values()) ## proba to assign variable
-        ),
-        'year_of_birth': birth_years,
-        'race_concept_id': np.random.choice(
-            list(race_dist.keys()),
-            n,
-            p=list(race_dist.values())
-        ),
-        'ethnicity_concept_id': np.random.choice(
-            list(ethnicity_dist.keys()),
-            n,
-            p=list(ethnicity_dist.values())
-        )
+        'gender_concept_id': concepts.gender.sample(rng, n),
+        'year_of_birth': profiles.year_of_birth,
+        'race_concept_id': concepts.race.sample(rng, n),
+        'ethnicity_concept_id': concepts.ethnicity.sample(rng, n)
     })
-    # other columns
-    df['month_of_birth'] = None
-    df['day_of_birth'] = None
-    df['birth_datetime'] = None
-    df['location_id'] = None
-    df['provider_id'] = None
-    df['care_site_id'] = None
-    df['person_source_value'] = None
-    df['gender_source_value'] = None
-    df['gender_source_concept_id'] = None
-    df['race_source_value'] = None
-    df['race_source_concept_id'] = None
-    df['ethnicity_source_value'] = None
-    df['ethnicity_source_concept_id'] = None
-
-    return df
-
-def generate_visit_table(person_ids, n_visits):
+
+    # all-null columns are left out, exporters add them at write time
+    return apply_schema('person', df)
+
+def draw_length_of_stay(spec, size, rng):
     """
-    Generate OMOP visit_occurrence table
-    """    
-    visit_ids = list(range(1000000000, n_visits + 1000000000))
-    start_date = pd.Timestamp('2015-01-01')
-    end_date = pd.Timestamp('2023-12-31')
-    date_range = (end_date - start_date).days
-
-    visit_types = {
-        9201: 0.3,     # IP | Inpatient Visit
-        9202: 0.7      # OP | Outpatient Visit
-    }
-    
-    # assign person_ids to sequential visits
-    # can look at a more realistic way to do person -> visit mapping down the line
-    assigned_person_ids = np.random.choice(person_ids, n_visits)
-    
-    visit_concepts = np.random.choice(
-        list(visit_types.keys()),
-        n_visits,
-        p=list(visit_types.values())
-    )
-    
-    # random offset from start date to create visit dates  
-    start_offsets = np.random.randint(0, date_range, n_visits)
-    visit_start_dates = [start_date + pd.Timedelta(days=int(offset)) for offset in start_offsets]
-    
-    # end dates based on visit type
-    visit_end_dates = []
-    for i in range(n_visits):
-        if visit_concepts[i] == 9201:  # IP | Inpatient Visit
-            length = np.random.randint(1, 15)
-            visit_end_dates.append(visit_start_dates[i] + pd.Timedelta(days=length))
-        else:
-            visit_end_dates.append(visit_start_dates[i]) # OP end on same day
+    Draw size lengths of stay (whole days) in one batched call
+    spec is a callable (rng, size) -> days or a dict with 'distribution' one of
+        fixed (days), uniform (low, high inclusive), geometric (p, support 1, 2, ...),
+        lognormal (mean, sigma of the underlying normal)
+    optional 'min' and 'max' clip the drawn days
+    """
+    if callable(spec):
+        return np.asarray(spec(rng, size), dtype=np.int64)
+
+    if spec['distribution'] == 'fixed':
+        days = np.full(size, spec['days'])
+    elif spec['distribution'] == 'uniform':
+        days = rng.integers(spec['low'], spec['high'] + 1, size)
+    elif spec['distribution'] == 'geometric':
+        days = rng.geometric(spec['p'], size)
+    elif spec['distribution'] == 'lognormal':
+        days = np.rint(rng.lognormal(spec['mean'], spec['sigma'], size))
+    else:
+        raise ValueError(f"unknown length of stay distribution: {spec['distribution']}")
+
+    if 'min' in spec or 'max' in spec:
+        days = np.clip(days, spec.get('min'), spec.get('max'))
+    return days.astype(np.int64)
+
+def draw_visit_counts(spec, n_persons, n_visits, rng):
+    """
+    Split n_visits over n_persons: a weight per person drawn from spec, then one multinomial draw
+    so the counts add up to exactly n_visits
+    spec is a dict with 'distribution' one of
+        uniform (equal weights), lognormal (sigma), gamma (shape, smaller is more skewed),
+        pareto (alpha, smaller is heavier tailed)
+    """
+    if n_persons == 0:
+        if n_visits:
+            raise ValueError("cannot assign visits without persons")
+        return np.zeros(0, dtype=np.int64)
+
+    if spec['distribution'] == 'uniform':
+        weights = np.ones(n_persons)
+    elif spec['distribution'] == 'lognormal':
+        weights = rng.lognormal(0.0, spec['sigma'], n_persons)
+    elif spec['distribution'] == 'gamma':
+        weights = rng.gamma(spec['shape'], 1.0, n_persons)
+    elif spec['distribution'] == 'pareto':
+        weights = rng.pareto(spec['alpha'], n_persons) + 1
+    else:
+        raise ValueError(f"unknown visits per person distribution: {spec['distribution']}")
+
+    return rng.multinomial(n_visits, weights / weights.sum())
+
+# default range of visit start dates, from the first date up to but not including the second
+VISIT_WINDOW = ('2015-01-01', '2023-12-31')
+
+def generate_visit_table(person_ids, n_visits, start_id=1000000000, rng=None, concepts=None, length_of_stay=None, visit_window=VISIT_WINDOW, birth_years=None, visits_per_person=None, previous_visit_ids=None):
+    """
+    Generate OMOP visit_occurrence table as per person timelines
+    Each person gets a number of visits drawn from visits_per_person (see draw_visit_counts, defaults to
+    visits_per_person in the definitions file), dated from the later of the window start and their birth
+    year (birth_years, aligned with person_ids) up to the window end. Rows are clustered by person and
+    chronological within each person, with preceding_visit_occurrence_id linking each visit to the last one
+    start_id is the first visit_occurrence_id, so shards of a larger cohort keep ids globally unique
+    visit_window is the (start, end) range of visit start dates, end excluded
+    length_of_stay maps visit_concept_id -> length of stay spec (see draw_length_of_stay),
+    visit types not listed end on the same day, defaults to length_of_stay in the definitions file
+    previous_visit_ids (aligned with person_ids, 0 for none) are the persons' last visits from earlier runs,
+    which their first visit here links to
+    """
+    rng = default_rng(rng)
+    concepts = concepts or load_concept_model()
+    if length_of_stay is None:
+        length_of_stay = concepts.length_of_stay
+    if visits_per_person is None:
+        visits_per_person = concepts.visits_per_person
+    person_ids = np.asarray(person_ids)
+    n_persons = len(person_ids)
+    visit_ids = np.arange(start_id, n_visits + start_id)
+    start_date = np.datetime64(visit_window[0], 'D')
+    end_date = np.datetime64(visit_window[1], 'D')
+
+    # heavy tailed visit counts per person, expanded to the person position of every visit
+    counts = draw_visit_counts(visits_per_person, n_persons, n_visits, rng)
+    visit_person = np.repeat(np.arange(n_persons), counts)
+
+    # each person's timeline starts at the later of the window start and 1 January of their birth year
+    first_date = np.full(n_persons, start_date)
+    if birth_years is not None:
+        birth_dates = (np.asarray(birth_years, dtype=np.int64) - 1970).astype('datetime64[Y]').astype('datetime64[D]')
+        first_date = np.minimum(np.maximum(first_date, birth_dates), end_date - 1)
+    span = (end_date - first_date).astype(np.int64)
+
+    # uniform dates within each timeline, sorted by person then date
+    # visits are already grouped by person, so the sort only orders dates within each person
+    start_offsets = (rng.random(n_visits) * span[visit_person]).astype(np.int64)
+    visit_start_dates = first_date[visit_person] + start_offsets
+    visit_start_dates = visit_start_dates[np.lexsort((visit_start_dates, visit_person))]
+
+    # ids run in timeline order, so the preceding visit is the previous row unless the person changes
+    first_visit = np.ones(n_visits, dtype=bool)
+    first_visit[1:] = visit_person[1:] != visit_person[:-1]
+    preceding_visit_ids = visit_ids - 1
+    if previous_visit_ids is not None:
+        # first visits of persons with earlier visits carry on from their last visit of the previous run
+        preceding_visit_ids[first_visit] = np.asarray(previous_visit_ids, dtype=np.int64)[visit_person[first_visit]]
+        first_visit &= preceding_visit_ids == 0
+    preceding_visit_ids = pd.arrays.IntegerArray(preceding_visit_ids, first_visit)
+
+    visit_concepts = concepts.visit_types.sample(rng, n_visits)
+
+    # end dates based on visit type, one batched length of stay draw per visit type
+    lengths = np.zeros(n_visits, dtype=np.int64)
+    for concept_id, spec in length_of_stay.items():
+        rows = np.flatnonzero(visit_concepts == concept_id)
+        lengths[rows] = draw_length_of_stay(spec, len(rows), rng)
+    visit_end_dates = visit_start_dates + lengths
     
     # create omop.visit_occurrence dataframe
     df = pd.DataFrame({
         'visit_occurrence_id': visit_ids,
-        'person_id': assigned_person_ids,
+        'person_id': person_ids[visit_person],
         'visit_concept_id': visit_concepts,
         'visit_start_date': visit_start_dates,
         'visit_end_date': visit_end_dates,
-        'visit_type_concept_id': 44818517  # Visit derived from encounter on claim (i.e. CDS)
+        'visit_type_concept_id': 44818517,  # Visit derived from encounter on claim (i.e. CDS)
+        'preceding_visit_occurrence_id': preceding_visit_ids
     })
-    df['visit_start_datetime'] = None
-    df['visit_end_datetime'] = None
-    df['provider_id'] = None
-    df['care_site_id'] = None
-    df['visit_source_value'] = None
-    df['visit_source_concept_id'] = None
-    df['admitted_from_concept_id'] = None
-    df['admitted_from_source_value'] = None
-    df['discharged_to_concept_id'] = None
-    df['discharged_to_source_value'] = None
-    df['preceding_visit_occurrence_id'] = None
-
-    return df
-
-def generate_condition_table(person_ids, visit_df):
+
+    # all-null columns are left out, exporters add them at write time
+    return apply_schema('visit_occurrence', df)
+
+# (min, max) events per visit drawn from the person's cluster
+CONDITIONS_PER_VISIT = (1, 3)
+DRUGS_PER_VISIT = (1, 2)
+
+def sample_cluster_events(visit_index, person_cluster, clusters, min_per_visit, max_per_visit, rng):
     """
-    Generate OMOP condition_occurrence table
-    """    
-    # define clusters of conditions and their distributions within clusters
-    # keeping these hard coded for simplicity, but would push all to a definitions file down the line
-    CONDITION_CLUSTERS = {
-        "cardiometabolic": {
-            316866: 0.30,  # Hypertensive disorder
-            201820: 0.20,  # Diabetes mellitus
-            321588: 0.15,  # Heart disease
-            381591: 0.15,  # Cerebrovascular disease
-            434376: 0.10,  # Acute MI
-            321052: 0.10   # Peripheral vascular disease
-        },
-        "respiratory": {
-            255848: 0.30,  # Pneumonia
-            255573: 0.25,  # Chronic obstructive lung disease
-            260139: 0.20,  # Acute bronchitis
-            256449: 0.15,  # Bronchiectasis
-            261880: 0.10   # Atelectasis
-        },
-        "musculoskeletal": {
-            80180: 0.30,   # Osteoarthritis
-            80809: 0.25,   # Rheumatoid arthritis
-            4046660: 0.20, # Chronic back pain
-            4291025: 0.15, # Inflammatory arthritis
-            4000634: 0.10  # Acute arthritis
-        },
-        "gastrointestinal": {
-            4027663: 0.30,  # Peptic ulcer
-            40398568: 0.20,  # Duodenal ulcer
-            201340: 0.20,  # Gastritis
-            4074815: 0.15,  # Inflammatory bowel disease
-            45470366: 0.15  # Oesophagitis
-        },
-        "mental_health": {
-            4152280: 0.30,  # Major depressive disorder
-            434613: 0.25,  # Generalized anxiety disorder
-            40388256: 0.20,  # Bipolar disorder
-            435783: 0.15,  # Schizophrenia
-            40388323: 0.10   # Post-traumatic stress disorder
-        }
-    }
-    # define distributions of clusters
-    CLUSTER_DISTRIBUTION = {
-        "cardiometabolic": 0.25,
-        "respiratory": 0.20,
-        "musculoskeletal": 0.20,
-        "gastrointestinal": 0.20,
-        "mental_health": 0.15
+    Columnar engine for cluster based event tables (conditions, drugs)
+    Draws min_per_visit to max_per_visit concepts per visit from the cluster of the visit's person,
+    in one batched draw per cluster. Returns dict of NumPy columns, ordered by person then visit
+    person_cluster is the cluster index of each person (PersonProfiles.cluster), clusters the Categorical of each cluster
+    """
+    n_persons = len(visit_index.person_ids)
+    visits_per_person = np.diff(visit_index.offsets)
+
+    # number of events per visit, expanded to one entry per event row
+    visit_person = np.repeat(np.arange(n_persons), visits_per_person)
+    events_per_visit = rng.integers(min_per_visit, max_per_visit + 1, len(visit_person))
+    row_visit = np.repeat(np.arange(len(visit_person)), events_per_visit)
+    row_person = visit_person[row_visit]
+    row_cluster = person_cluster[row_person]
+
+    # one categorical draw per cluster covering all of its rows
+    concept_ids = np.zeros(len(row_visit), dtype=np.int64)
+    for k, cluster in enumerate(clusters):
+        rows = np.flatnonzero(row_cluster == k)
+        concept_ids[rows] = cluster.sample(rng, len(rows))
+
+    return {
+        'person_id': visit_index.person_ids[row_person],
+        'concept_id': concept_ids,
+        'visit_occurrence_id': visit_index.visit_occurrence_id[row_visit],
+        'visit_start_date': visit_index.visit_start_date[row_visit]
     }
 
-    # assign clusters to persons / visits / dates
-    # for simplicity, each person only gets assigned a single disease cluster
-    person_cluster_map = {}
-    for person_id in person_ids:
-
-        # give each person a cluster based on the distribution
-        assigned_cluster = np.random.choice(
-            list(CLUSTER_DISTRIBUTION.keys()),
-            p=list(CLUSTER_DISTRIBUTION.values())
-        )
-        
-        # create dict of person/visits and start date
-        person_visits = visit_df[visit_df['person_id'] == person_id].copy()
-        visit_info = person_visits[['visit_occurrence_id', 'visit_start_date']].to_dict('records')
-        
-        # create dict of person/cluster/visits/visit dates
-        person_cluster_map[person_id] = {
-            'cluster': assigned_cluster,
-            'visits': visit_info
-        }
-    
-    # assign conditions from each cluster to person/visit
-    condition_records = []
-    condition_id = 1000000000
-    for person_id, info in person_cluster_map.items():
-
-        # pull out cluster data
-        cluster = info['cluster']
-        cluster_concepts = CONDITION_CLUSTERS[cluster]
-        
-        # for each visit, assign 1 to 3 assoc conditions
-        for visit in info['visits']:
-            n_conditions = np.random.randint(1, 4)
-            
-            # keep to the assigned cluster
-            selected_conditions = np.random.choice(
-                list(cluster_concepts.keys()),
-                size=n_conditions,
-                p=list(cluster_concepts.values())
-            )
-            
-            # create record per condition, attach visit/date
-            for condition in selected_conditions:
-                condition_records.append({
-                    'condition_occurrence_id': condition_id,
-                    'person_id': person_id,
-                    'condition_concept_id': condition,
-                    'condition_start_date': visit['visit_start_date'],
-                    'condition_start_datetime': None,
-                    'condition_end_date': None,
-                    'condition_end_datetime': None,
-                    'condition_type_concept_id': 32020, # EHR encounter diagnosis
-                    'condition_status_concept_id': None,
-                    'stop_reason': None,
-                    'provider_id': None,
-                    'visit_occurrence_id': visit['visit_occurrence_id'],
-                    'visit_detail_id': None,
-                    'condition_source_value': None,
-                    'condition_source_concept_id': None,
-                    'condition_status_source_value': None
-                })
-                condition_id += 1
-    
-    df = pd.DataFrame.from_records(condition_records)
-    
-    return df
+def generate_condition_table(person_ids, visit_df, visit_index=None, start_id=1000000000, rng=None, concepts=None, profiles=None):
+    """
+    Generate OMOP condition_occurrence table
+    visit_index (from build_person_visit_index) can be shared across generators to avoid rebuilding it
+    start_id is the first row id, so shards of a larger cohort keep ids globally unique
+    concepts is the compiled ConceptModel, defaults to definitions/concepts.json
+    profiles (from generate_person_profiles) should be shared with generate_drug_exposure_table,
+    otherwise fresh profiles are drawn and drugs no longer match conditions
+    """
+    rng = default_rng(rng)
+    concepts = concepts or load_concept_model()
+    if visit_index is None:
+        visit_index = build_person_visit_index(person_ids, visit_df)
+    if profiles is None:
+        profiles = generate_person_profiles(person_ids, rng, concepts)
+
+    # 1 to 3 assoc conditions per visit from the person's cluster
+    events = sample_cluster_events(
+        visit_index,
+        profiles.cluster,
+        concepts.condition_clusters,
+        *CONDITIONS_PER_VISIT,
+        rng=rng
+    )
+    n_conditions = len(events['concept_id'])
+
+    df = pd.DataFrame({
+        'condition_occurrence_id': np.arange(start_id, start_id + n_conditions),
+        'person_id': events['person_id'],
+        'condition_concept_id': events['concept_id'],
+        'condition_start_date': events['visit_start_date'],
+        'condition_type_concept_id': 32020, # EHR encounter diagnosis
+        'visit_occurrence_id': events['visit_occurrence_id']
+    })
 
-def generate_drug_exposure_table(person_ids, visit_df):
+    # all-null columns are left out, exporters add them at write time
+    return apply_schema('condition_occurrence', df)
+
+def generate_drug_exposure_table(person_ids, visit_df, visit_index=None, start_id=1000000000, rng=None, concepts=None, profiles=None):
     """
     Generate OMOP drug_exposure table
-    """    
-    # clusters of drugs that match conditions above
-    DRUG_CLUSTERS = {
-        "cardiometabolic": {
-            1112807: 0.35,  # Aspirin
-            1503297: 0.35,  # Metformin
-            1545958: 0.30   # Atorvastatin
-        },
-        "respiratory": {
-            1154343: 0.40,  # Albuterol / Salbutamol
-            1550557: 0.35,  # Prednisolone
-            1154161: 0.25   # Montelukast
-        },
-        "musculoskeletal": {
-            1201620: 0.30,  # Codeine
-            1115008: 0.55,  # Naproxen
-            1110410: 0.15   # Morphine
-        },
-        "gastrointestinal": {
-            948078: 0.65,   # Pantoprazole
-            961047: 0.35    # Ranitidine
-        },
-        "mental_health": {
-            739138: 0.40,   # Sertraline
-            1153013: 0.35,  # Promethazine
-            19124477: 0.25  # Lithium
-        }
-    }
-    
-    # keep same distributions
-    DRUG_CLUSTER_DISTRIBUTION = {
-        "cardiometabolic": 0.25,
-        "respiratory": 0.20,
-        "musculoskeletal": 0.20,
-        "gastrointestinal": 0.20,
-        "mental_health": 0.15
-    }
+    visit_index (from build_person_visit_index) can be shared across generators to avoid rebuilding it
+    start_id is the first row id, so shards of a larger cohort keep ids globally unique
+    concepts is the compiled ConceptModel, defaults to definitions/concepts.json
+    profiles (from generate_person_profiles) should be the ones used for the condition table
+    """
+    rng = default_rng(rng)
+    concepts = concepts or load_concept_model()
+    if visit_index is None:
+        visit_index = build_person_visit_index(person_ids, visit_df)
+    if profiles is None:
+        profiles = generate_person_profiles(person_ids, rng, concepts)
 
-    # mapping of persons to drug cluster and visits
-    person_cluster_map = {}
-    for person_id in person_ids:
-        assigned_cluster = np.random.choice(
-            list(DRUG_CLUSTER_DISTRIBUTION.keys()),
-            p=list(DRUG_CLUSTER_DISTRIBUTION.values())
-        )
-        
-        person_visits = visit_df[visit_df['person_id'] == person_id].copy()
-        visit_info = person_visits[['visit_occurrence_id', 'visit_start_date']].to_dict('records')
-        
-        person_cluster_map[person_id] = {
-            'cluster': assigned_cluster,
-            'visits': visit_info
-        }
-    
-    drug_records = []
-    drug_exposure_id = 1000000000
-    
-    for person_id, info in person_cluster_map.items():
-        cluster = info['cluster']
-        cluster_concepts = DRUG_CLUSTERS[cluster]
-        
-        for visit in info['visits']:
-            n_drugs = np.random.randint(1, 3)  # 1-2 drugs per visit
-            
-            # Keep to the assigned cluster
-            selected_drugs = np.random.choice(
-                list(cluster_concepts.keys()),
-                size=n_drugs,
-                p=list(cluster_concepts.values())
-            )
-            
-            for drug in selected_drugs:
-                drug_records.append({
-                    'drug_exposure_id': drug_exposure_id,
-                    'person_id': person_id,
-                    'drug_concept_id': drug,
-                    'drug_exposure_start_date': visit['visit_start_date'],
-                    'drug_exposure_start_datetime': None,
-                    'drug_exposure_end_date': visit['visit_start_date'],
-                    'drug_exposure_end_datetime': None,
-                    'verbatim_end_date': None,
-                    'drug_type_concept_id': 38000177,  # Prescription written
-                    'stop_reason': None,
-                    'refills': None,
-                    'quantity': None,
-                    'days_supply': None,
-                    'sig': None,
-                    'route_concept_id': 4132161,  # Oral
-                    'lot_number': None,
-                    'provider_id': None,
-                    'visit_occurrence_id': visit['visit_occurrence_id'],
-                    'visit_detail_id': None,
-                    'drug_source_value': None,
-                    'drug_source_concept_id': None,
-                    'route_source_value': None,
-                    'dose_unit_source_value': None
-                })
-                drug_exposure_id += 1
-    
-    df = pd.DataFrame.from_records(drug_records)
-    
-    return df
+    # 1-2 drugs per visit, from the same cluster as the person's conditions
+    events = sample_cluster_events(
+        visit_index,
+        profiles.cluster,
+        concepts.drug_clusters,
+        *DRUGS_PER_VISIT,
+        rng=rng
+    )
+    n_drugs = len(events['concept_id'])
+
+    df = pd.DataFrame({
+        'drug_exposure_id': np.arange(start_id, start_id + n_drugs),
+        'person_id': events['person_id'],
+        'drug_concept_id': events['concept_id'],
+        'drug_exposure_start_date': events['visit_start_date'],
+        'drug_exposure_end_date': events['visit_start_date'],
+        'drug_type_concept_id': 38000177,  # Prescription written
+        'route_concept_id': 4132161,  # Oral
+        'visit_occurrence_id': events['visit_occurrence_id']
+    })
 
-def generate_measurement_table(person_ids, visit_df):
+    # all-null columns are left out, exporters add them at write time
+    return apply_schema('drug_exposure', df)
+
+def generate_measurement_table(person_ids, visit_df, visit_index=None, chunk_size=1000000, start_id=1000000000, rng=None, concepts=None):
     """
     Generate OMOP measurement table with common clinical measurements
+    visit_index (from build_person_visit_index) can be shared across generators to avoid rebuilding it
+    start_id is the first row id, so shards of a larger cohort keep ids globally unique
+    concepts is the compiled ConceptModel, defaults to definitions/concepts.json
+    chunk_size caps the number of visits drawn at once (memory ~ chunk_size x no. of measurements)
     """
-    # Define common measurements and their normal ranges/distributions
-    MEASUREMENTS = {
-        "Hemoglobin": {
-            "concept_id": 3000963,
-            "unit_concept_id": 8713,  # gram per deciliter
-            "mean": 12,
-            "std": 1.5,
-            "probability": 0.8  # chance of having measured
-        },
-        "Creatinine": {
-            "concept_id": 3032033,
-            "unit_concept_id": 8749,  # micromole per liter
-            "mean": 70,
-            "std": 30,
-            "probability": 0.6
-        },
-        "BMI": {
-            "concept_id": 3038553,
-            "unit_concept_id": 9531,  # kilogram per m^2
-            "mean": 27.0,
-            "std": 5.0,
-            "probability": 0.9
-        },
-        "Systolic Blood Pressure": {
-            "concept_id": 3004249,
-            "unit_concept_id": 8876,  # mmHg
-            "mean": 130,
-            "std": 25,
-            "probability": 0.9
-        }
-    }
+    rng = default_rng(rng)
+    concepts = concepts or load_concept_model()
+    if visit_index is None:
+        visit_index = build_person_visit_index(person_ids, visit_df)
+
+    # common measurements and their normal ranges/distributions, from the definitions file
+    concept_ids = concepts.measurement_concept_ids
+    unit_concept_ids = concepts.measurement_unit_concept_ids
+    means = concepts.measurement_means
+    stds = concepts.measurement_stds
+    probabilities = concepts.measurement_probabilities
+
+    n_persons = len(visit_index.person_ids)
+    visit_person = np.repeat(np.arange(n_persons), np.diff(visit_index.offsets))
+    n_visits = len(visit_person)
+
+    # draw visits x measurements in chunks of visits so the dense mask stays bounded in memory
+    visit_parts = [np.zeros(0, dtype=np.int64)]
+    measure_parts = [np.zeros(0, dtype=np.int64)]
+    value_parts = [np.zeros(0)]
+    for start in range(0, n_visits, chunk_size):
+        stop = min(start + chunk_size, n_visits)
+
+        # bernoulli mask of measured cells, row-major so rows stay ordered by visit then measurement
+        measured = rng.random((stop - start, len(concept_ids))) < probabilities
+        rows, measures = np.nonzero(measured)
+
+        # normal values only for the kept cells
+        values = np.round(rng.normal(means[measures], stds[measures]), 0)
+
+        visit_parts.append(rows + start)
+        measure_parts.append(measures)
+        value_parts.append(values)
+
+    row_visit = np.concatenate(visit_parts)
+    row_measure = np.concatenate(measure_parts)
+    n_measurements = len(row_visit)
+
+    df = pd.DataFrame({
+        'measurement_id': np.arange(start_id, start_id + n_measurements),
+        'person_id': visit_index.person_ids[visit_person[row_visit]],
+        'measurement_concept_id': concept_ids[row_measure],
+        'measurement_date': visit_index.visit_start_date[row_visit],
+        'measurement_type_concept_id': 44818701,  # Lab result
+        'value_as_number': np.concatenate(value_parts),
+        'unit_concept_id': unit_concept_ids[row_measure],
+        'visit_occurrence_id': visit_index.visit_occurrence_id[row_visit]
+    })
 
-    measurement_records = []
-    measurement_id = 1000000000
-
-    for person_id in person_ids:
-        person_visits = visit_df[visit_df['person_id'] == person_id]
-        
-        for _, visit in person_visits.iterrows():
-            for measure_name, measure_info in MEASUREMENTS.items():
-                
-                if np.random.random() < measure_info["probability"]:
-                    value = round(np.random.normal(
-                        measure_info["mean"],
-                        measure_info["std"]
-                    ), 0)
-                    
-                    measurement_records.append({
-                        'measurement_id': measurement_id,
-                        'person_id': person_id,
-                        'measurement_concept_id': measure_info["concept_id"],
-                        'measurement_date': visit['visit_start_date'],
-                        'measurement_datetime': None,
-                        'measurement_time': None,
-                        'measurement_type_concept_id': 44818701,  # Lab result
-                        'operator_concept_id': None,
-                        'value_as_number': value,
-                        'value_as_concept_id': None,
-                        'unit_concept_id': measure_info["unit_concept_id"],
-                        'range_low': None,
-                        'range_high': None,
-                        'provider_id': None,
-                        'visit_occurrence_id': visit['visit_occurrence_id'],
-                        'visit_detail_id': None,
-                        'measurement_source_value': None,
-                        'measurement_source_concept_id': None,
-                        'unit_source_value': None,
-                        'value_source_value': None,
-                        'unit_source_concept_id': None,
-                        'measurement_event_id': None,
-                        'meas_event_field_concept_id': None
-                    })
-                    measurement_id += 1
-
-    df = pd.DataFrame.from_records(measurement_records)
-   
-    return df
\ No newline at end of file
+    # all-null columns are left out, exporters add them at write time
+    return apply_schema('measurement', df)
@@ -0,0 +1,460 @@
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from src.schema import TABLE_COLUMNS, COLUMN_TYPES, FOREIGN_KEYS, load_ddl
+
+"""
+Output sinks for generated OMOP tables
+Sinks receive tables one batch (shard) at a time, so nothing needs to hold the full cohort in memory
+append=True adds to the output of a previous run instead of replacing it
+checkpoint() returns the sink's output state after the last write, restore(state) rolls the output
+back to it, dropping anything written after the checkpoint (e.g. a shard cut short by a crash)
+clear(table_name) removes the output of a table the run does not generate
+"""
+
+# file name suffix of each CSV compression
+CSV_COMPRESSION = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst'
+}
+
+def csv_files(output_dir, table_name):
+    """
+    Existing CSV files of a table in part order, a single <table_name>.csv or <table_name>-NNN.csv part files,
+    plain or compressed
+    """
+    if not os.path.isdir(output_dir):
+        return []
+    pattern = re.compile(rf"{table_name}(-\d{{3}})?\.csv(\.gz|\.zst)?$")
+    return sorted(os.path.join(output_dir, name) for name in os.listdir(output_dir) if pattern.match(name))
+
+class CsvSink:
+    """
+    Write each OMOP table to <output_dir>/<table_name>.csv, appending one batch at a time
+    n_parts > 1 splits every batch over part files <table_name>-000.csv, <table_name>-001.csv, ...
+    compression 'gzip' or 'zstd' compresses each batch as it is written (.csv.gz / .csv.zst) at
+    compression_level (default 1, the fastest), appended batches are separate compressed members that
+    gzip, zstd, DuckDB and pyarrow read as one file
+    Part files of all tables are written concurrently by a pool of threads with the pyarrow CSV writer:
+    write() queues the batch and returns, checkpoint() and close() wait for queued writes
+    """
+    def __init__(self, output_dir='export', append=False, n_parts=1, compression=None, compression_level=1, threads=None):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError("pyarrow is required for csv output: pip install pyarrow")
+        if compression not in CSV_COMPRESSION:
+            raise ValueError(f"unknown csv compression: {compression}")
+        if n_parts < 1:
+            raise ValueError("n_parts must be at least 1")
+
+        self.output_dir = output_dir
+        self.append = append
+        self.n_parts = n_parts
+        self.compression = compression
+        self.compression_level = compression_level
+        self._started = set()
+        # futures of the last queued batch of every table
+        self._pending = {}
+        self._pool = ThreadPoolExecutor(max_workers=threads or min(len(TABLE_COLUMNS) * n_parts, os.cpu_count() or 1))
+        os.makedirs(output_dir, exist_ok=True)
+
+    def path(self, table_name, part=0):
+        suffix = CSV_COMPRESSION[self.compression]
+        if self.n_parts == 1:
+            return os.path.join(self.output_dir, f"{table_name}.csv{suffix}")
+        return os.path.join(self.output_dir, f"{table_name}-{part:03d}.csv{suffix}")
+
+    def paths(self, table_name):
+        return [self.path(table_name, part) for part in range(self.n_parts)]
+
+    def write(self, table_name, df):
+        # batches of a table append to the same files, so the previous batch must be written first
+        self._wait(table_name)
+        # first batch replaces any output of the table from a previous run, whatever its parts or compression
+        if table_name not in self._started and not self.append:
+            for path in csv_files(self.output_dir, table_name):
+                os.remove(path)
+        self._started.add(table_name)
+
+        # each part gets a contiguous slice of rows
+        self._pending[table_name] = [
+            self._pool.submit(
+                self._write_part,
+                table_name,
+                self.path(table_name, part),
+                df.iloc[len(df) * part // self.n_parts:len(df) * (part + 1) // self.n_parts]
+            )
+            for part in range(self.n_parts)
+        ]
+
+    def clear(self, table_name):
+        """
+        Remove the output of a table not written by this run
+        """
+        self._wait(table_name)
+        for path in csv_files(self.output_dir, table_name):
+            os.remove(path)
+
+    def _write_part(self, table_name, path, df):
+        import pyarrow as pa
+        import pyarrow.csv as csv
+
+        # only a new (or emptied) file gets a header, so appended batches continue the same table
+        header = not os.path.exists(path) or os.path.getsize(path) == 0
+        if not header and len(df) == 0:
+            return
+        # format in memory then compress in one call, arrow's streaming gzip is fixed at the slow level 9
+        # all-null columns not materialised by the generators are written as empty fields
+        out = pa.BufferOutputStream()
+        if header:
+            out.write((','.join(TABLE_COLUMNS[table_name]) + '\n').encode())
+        csv.write_csv(to_arrow_table(table_name, df, wide_integers=True), out, csv.WriteOptions(include_header=False))
+        data = out.getvalue()
+        if self.compression:
+            data = pa.Codec(self.compression, compression_level=self.compression_level).compress(data)
+        with open(path, 'ab') as f:
+            f.write(data)
+
+    def _wait(self, table_name=None):
+        """
+        Wait for the queued writes of table_name (default all tables), re-raising any write error
+        """
+        for name in [table_name] if table_name else list(self._pending):
+            for future in self._pending.pop(name, []):
+                future.result()
+
+    def checkpoint(self):
+        """
+        Size in bytes of every table file, files not yet written by this sink count as empty unless appending
+        """
+        self._wait()
+        return {
+            os.path.basename(path): os.path.getsize(path)
+            if (table_name in self._started or self.append) and os.path.exists(path) else 0
+            for table_name in TABLE_COLUMNS
+            for path in self.paths(table_name)
+        }
+
+    def restore(self, state):
+        """
+        Truncate every table file to its checkpointed size, empty files are removed so they get a header again
+        """
+        self._wait()
+        for table_name in TABLE_COLUMNS:
+            for path in self.paths(table_name):
+                if not os.path.exists(path):
+                    continue
+                size = state.get(os.path.basename(path), 0)
+                if os.path.getsize(path) < size:
+                    raise ValueError(f"{path} is shorter than its checkpoint, cannot resume")
+                if size == 0:
+                    os.remove(path)
+                else:
+                    os.truncate(path, size)
+
+    def close(self):
+        try:
+            self._wait()
+        finally:
+            self._pool.shutdown()
+
+# date column used for year partitioning, person has no event date so is never year partitioned
+PARTITION_DATE_COLUMNS = {
+    'visit_occurrence': 'visit_start_date',
+    'condition_occurrence': 'condition_start_date',
+    'drug_exposure': 'drug_exposure_start_date',
+    'measurement': 'measurement_date'
+}
+
+def arrow_schema(table_name, wide_integers=False):
+    """
+    Arrow schema for an OMOP table, typed from the DDL in validate_omop.sql
+    wide_integers types integer columns as int64 instead, for csv output where the type only
+    affects formatting and ids past the int32 range must still be written
+    """
+    import pyarrow as pa
+
+    sql_to_arrow = {
+        'integer': pa.int64() if wide_integers else pa.int32(),
+        'date': pa.date32(),
+        'timestamp': pa.timestamp('us'),
+        'numeric': pa.float64(),
+        'varchar': pa.string(),
+        'text': pa.string()
+    }
+    return pa.schema([
+        (column, sql_to_arrow[sql_type]) for column, sql_type in COLUMN_TYPES[table_name].items()
+    ])
+
+def to_arrow_table(table_name, df, wide_integers=False):
+    """
+    Convert a generated DataFrame to an Arrow table with OMOP column order and DDL types
+    Raises if an id does not fit the DDL integer type rather than silently wrapping,
+    see arrow_schema for wide_integers
+    """
+    import pyarrow as pa
+
+    schema = arrow_schema(table_name, wide_integers)
+    arrays = []
+    for field in schema:
+        if field.name not in df.columns:
+            # all-null columns are not materialised by the generators
+            arrays.append(pa.nulls(len(df), field.type))
+            continue
+        # category columns arrive as dictionary arrays and are decoded by the cast
+        arrays.append(pa.array(df[field.name], from_pandas=True).cast(field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+class ParquetSink:
+    """
+    Write each OMOP table as a directory of Parquet files, <output_dir>/<table_name>/part-<batch>.parquet
+    partition_by='year' or 'person_bucket' writes hive style partitions (e.g. year=2020/) that DuckDB
+    and Spark can prune, person_bucket is person_id % n_buckets
+    """
+    def __init__(self, output_dir='export', compression='zstd', row_group_size=1000000,
+                 partition_by=None, n_buckets=64, append=False):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError("pyarrow is required for parquet output: pip install pyarrow")
+        if partition_by not in (None, 'year', 'person_bucket'):
+            raise ValueError(f"unknown partition_by: {partition_by}")
+
+        self.output_dir = output_dir
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.partition_by = partition_by
+        self.n_buckets = n_buckets
+        self.append = append
+        self._batches = {}
+
+    def path(self, table_name):
+        return os.path.join(self.output_dir, table_name)
+
+    def partition_column(self, table_name, df):
+        """
+        Return (name, values) of the hive partition column for df, or None if not partitioned
+        """
+        if self.partition_by == 'year' and table_name in PARTITION_DATE_COLUMNS:
+            dates = pd.to_datetime(df[PARTITION_DATE_COLUMNS[table_name]])
+            return 'year', dates.dt.year.to_numpy()
+        if self.partition_by == 'person_bucket':
+            return 'person_bucket', df['person_id'].to_numpy() % self.n_buckets
+        return None
+
+    def next_batch(self, table_name):
+        """
+        Batch number following the part files already in the table directory (including partitions)
+        """
+        batches = [
+            int(name[len('part-'):len('part-') + 5])
+            for _, _, names in os.walk(self.path(table_name))
+            for name in names if name.startswith('part-') and name.endswith('.parquet')
+        ]
+        return max(batches) + 1 if batches else 0
+
+    def write(self, table_name, df):
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+
+        # first batch replaces any output from a previous run, or in append mode numbers on from it
+        table_dir = self.path(table_name)
+        if table_name not in self._batches:
+            if self.append:
+                self._batches[table_name] = self.next_batch(table_name)
+            else:
+                shutil.rmtree(table_dir, ignore_errors=True)
+        batch = self._batches.get(table_name, 0)
+        os.makedirs(table_dir, exist_ok=True)
+        self._batches[table_name] = batch + 1
+
+        table = to_arrow_table(table_name, df)
+        partition = self.partition_column(table_name, df)
+        if partition is None:
+            pq.write_table(
+                table,
+                os.path.join(table_dir, f"part-{batch:05d}.parquet"),
+                compression=self.compression,
+                row_group_size=self.row_group_size
+            )
+            return
+
+        name, values = partition
+        table = table.append_column(name, pa.array(values, type=pa.int32()))
+        ds.write_dataset(
+            table,
+            table_dir,
+            format='parquet',
+            partitioning=ds.partitioning(pa.schema([(name, pa.int32())]), flavor='hive'),
+            basename_template=f"part-{batch:05d}-{{i}}.parquet",
+            existing_data_behavior='overwrite_or_ignore',
+            file_options=ds.ParquetFileFormat().make_write_options(compression=self.compression),
+            max_rows_per_group=self.row_group_size,
+            min_rows_per_group=min(self.row_group_size, len(table)) or 1
+        )
+
+    def clear(self, table_name):
+        """
+        Remove the output of a table not written by this run
+        """
+        shutil.rmtree(self.path(table_name), ignore_errors=True)
+        self._batches.pop(table_name, None)
+
+    def checkpoint(self):
+        """
+        Next batch number of every table
+        """
+        return {
+            table_name: self._batches.get(table_name, self.next_batch(table_name) if self.append else 0)
+            for table_name in TABLE_COLUMNS
+        }
+
+    def restore(self, state):
+        """
+        Remove part files of batches written after the checkpoint
+        """
+        for table_name in TABLE_COLUMNS:
+            for root, _, names in os.walk(self.path(table_name)):
+                for name in names:
+                    if name.startswith('part-') and int(name[len('part-'):len('part-') + 5]) >= state.get(table_name, 0):
+                        os.remove(os.path.join(root, name))
+            self._batches.pop(table_name, None)
+
+    def close(self):
+        pass
+
+class DuckDbSink:
+    """
+    Load OMOP tables straight into an embedded DuckDB database file, skipping the CSV round trip
+    Tables are created with the DDL from validate_omop.sql and each batch is inserted as Arrow,
+    so primary key, not null and foreign key constraints are enforced on insert
+    """
+    def __init__(self, output_dir='export', database='omop.duckdb', append=False):
+        try:
+            import duckdb
+        except ImportError:
+            raise ImportError("duckdb is required for duckdb output: pip install duckdb")
+
+        os.makedirs(output_dir, exist_ok=True)
+        self.database_path = os.path.join(output_dir, database)
+        self.con = duckdb.connect(self.database_path)
+        self.report = None
+
+        # drop in reverse dependency order, then create with the validate_omop.sql DDL
+        # in append mode existing tables are kept and only missing ones are created
+        ddl = load_ddl()
+        existing = {row[0] for row in self.con.execute("select table_name from information_schema.tables").fetchall()}
+        if not append:
+            for table_name in reversed(list(ddl)):
+                self.con.execute(f"drop table if exists {table_name}")
+            existing = set()
+        for table_name in ddl:
+            if table_name not in existing:
+                self.con.execute(ddl[table_name]['statement'])
+
+        # next id of every table for checkpoints, the primary key is the first column of every table
+        self._next_ids = {
+            table_name: self.con.execute(
+                f"select coalesce(max({TABLE_COLUMNS[table_name][0]}) + 1, 0) from {table_name}"
+            ).fetchone()[0]
+            for table_name in TABLE_COLUMNS
+        }
+
+    def write(self, table_name, df):
+        batch = to_arrow_table(table_name, df)
+        self.con.register('batch', batch)
+        try:
+            self.con.execute(f"insert into {table_name} select * from batch")
+        finally:
+            self.con.unregister('batch')
+        if len(df):
+            id_column = TABLE_COLUMNS[table_name][0]
+            self._next_ids[table_name] = max(self._next_ids[table_name], int(df[id_column].max()) + 1)
+
+    def clear(self, table_name):
+        """
+        Empty a table not written by this run
+        """
+        self.con.execute(f"delete from {table_name}")
+        self._next_ids[table_name] = 0
+
+    def checkpoint(self):
+        """
+        Next id of every table
+        """
+        return dict(self._next_ids)
+
+    def restore(self, state):
+        """
+        Delete rows with ids from the checkpointed next id on, referencing tables first
+        """
+        for table_name in reversed(list(TABLE_COLUMNS)):
+            next_id = state.get(table_name, 0)
+            self.con.execute(f"delete from {table_name} where {TABLE_COLUMNS[table_name][0]} >= {next_id}")
+            self._next_ids[table_name] = next_id
+
+    def check(self):
+        """
+        Row counts per table and orphan counts per foreign key
+        """
+        row_counts = {
+            table_name: self.con.execute(f"select count(*) from {table_name}").fetchone()[0]
+            for table_name in TABLE_COLUMNS
+        }
+        orphans = {}
+        for table_name, column, ref_table, ref_column in FOREIGN_KEYS:
+            orphans[f"{table_name}.{column} -> {ref_table}.{ref_column}"] = self.con.execute(
+                f"""
+                select count(*) from {table_name} t
+                anti join {ref_table} r on t.{column} = r.{ref_column}
+                where t.{column} is not null
+                """
+            ).fetchone()[0]
+        return {'row_counts': row_counts, 'foreign_key_violations': orphans}
+
+    def close(self):
+        self.report = self.check()
+        for table_name, n_rows in self.report['row_counts'].items():
+            print(f"{table_name}: {n_rows} rows loaded into {self.database_path}")
+        for key, n_orphans in self.report['foreign_key_violations'].items():
+            if n_orphans:
+                print(f"constraint violation: {n_orphans} rows in {key}")
+        self.con.close()
+
+SINKS = {
+    'csv': CsvSink,
+    'parquet': ParquetSink,
+    'duckdb': DuckDbSink
+}
+
+def sink_options(output_format, options=None):
+    """
+    options of the output_format sink with its defaults filled in (output_dir and append excluded), as
+    recorded in the manifest so later runs on the dataset write with the same layout
+    Raises ValueError for options the sink does not take
+    """
+    import inspect
+
+    if output_format not in SINKS:
+        raise ValueError(f"unknown output format: {output_format}")
+    parameters = inspect.signature(SINKS[output_format]).parameters
+    defaults = {name: p.default for name, p in parameters.items() if name not in ('output_dir', 'append')}
+    unknown = [name for name in options or {} if name not in defaults]
+    if unknown:
+        raise ValueError(f"{output_format} output does not take options {unknown}")
+    return {**defaults, **(options or {})}
+
+def make_sink(output_format='csv', output_dir='export', **options):
+    """
+    Create the output sink for output_format ('csv', 'parquet' or 'duckdb'), options are passed to the sink
+    """
+    if output_format not in SINKS:
+        raise ValueError(f"unknown output format: {output_format}")
+    return SINKS[output_format](output_dir, **options)
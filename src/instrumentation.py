@@ -0,0 +1,197 @@
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+"""
+Instrumentation for generation runs
+StageRecorder times each generation stage (rows, rows/sec, peak memory, optional profiler) and is
+picklable so worker processes can record their own stages. RunReport collects the stage records of
+every shard, calls progress callbacks and produces a structured JSON run report.
+"""
+
+PROFILERS = (None, 'cprofile', 'pyinstrument')
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in MB, None where the resource module is unavailable
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+class StageRecorder:
+    """
+    Record timings of generation stages
+    profile='cprofile' or 'pyinstrument' writes one profile per stage (and shard) to profile_dir
+    trace_memory adds per-stage tracemalloc peaks, which slows pandas-heavy stages
+    """
+    def __init__(self, profile=None, profile_dir='profiles', trace_memory=False):
+        if profile not in PROFILERS:
+            raise ValueError(f"unknown profiler: {profile}")
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        self.records = []
+
+    def options(self):
+        """
+        Settings to build an equivalent recorder in a worker process
+        """
+        return {'profile': self.profile, 'profile_dir': self.profile_dir, 'trace_memory': self.trace_memory}
+
+    @contextmanager
+    def stage(self, name, shard=None):
+        """
+        Time the enclosed block, the caller sets record['rows'] to the rows it produced
+        """
+        record = {'stage': name, 'shard': shard, 'rows': 0}
+        profiler = self._start_profiler()
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            record['rows_per_sec'] = record['rows'] / record['seconds'] if record['seconds'] > 0 else None
+            record['peak_tracemalloc_mb'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2 if self.trace_memory else None
+            record['peak_rss_mb'] = peak_rss_mb()
+            self._stop_profiler(profiler, name, shard)
+            self.records.append(record)
+
+    def _start_profiler(self):
+        if self.profile == 'cprofile':
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+        if self.profile == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                raise ImportError("pyinstrument is required for profile='pyinstrument': pip install pyinstrument")
+            profiler = Profiler()
+            profiler.start()
+            return profiler
+        return None
+
+    def _stop_profiler(self, profiler, name, shard):
+        if profiler is None:
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        label = name if shard is None else f"{name}-shard{shard:05d}"
+        if self.profile == 'cprofile':
+            profiler.disable()
+            profiler.dump_stats(os.path.join(self.profile_dir, f"{label}.prof"))
+        else:
+            profiler.stop()
+            with open(os.path.join(self.profile_dir, f"{label}.html"), 'w') as f:
+                f.write(profiler.output_html())
+
+class RunReport:
+    """
+    Collect stage records and table sizes over a run, with periodic progress callbacks
+    progress is called with a progress dict at most every progress_interval seconds and after the last shard
+    """
+    def __init__(self, progress=None, progress_interval=10.0, **recorder_options):
+        self.recorder = StageRecorder(**recorder_options)
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.tables = {}
+        self.start_time = time.perf_counter()
+        self._last_progress = None
+        self.meta = {}
+
+    def add_shard(self, shard, tables, stage_records):
+        """
+        Add the tables and worker stage records of a generated shard
+        """
+        self.recorder.records.extend(stage_records)
+        for table_name, df in tables.items():
+            stats = self.tables.setdefault(table_name, {'rows': 0, 'bytes': 0})
+            stats['rows'] += len(df)
+            stats['bytes'] += int(df.memory_usage(deep=True).sum())
+
+    def shard_done(self, shards_done, n_shards, persons_done, n_persons):
+        """
+        Report progress after a shard is written
+        """
+        now = time.perf_counter()
+        last = shards_done == n_shards
+        if self.progress is None:
+            return
+        if not last and self._last_progress is not None and now - self._last_progress < self.progress_interval:
+            return
+        self._last_progress = now
+
+        elapsed = now - self.start_time
+        rows = sum(stats['rows'] for stats in self.tables.values())
+        self.progress({
+            'shards_done': shards_done,
+            'n_shards': n_shards,
+            'persons_done': persons_done,
+            'n_persons': n_persons,
+            'rows': rows,
+            'elapsed_seconds': elapsed,
+            'rows_per_sec': rows / elapsed if elapsed > 0 else None,
+            'eta_seconds': elapsed * (n_persons - persons_done) / persons_done if persons_done else None,
+            'peak_rss_mb': peak_rss_mb()
+        })
+
+    def stage_totals(self):
+        """
+        Stage records summed over shards
+        """
+        totals = {}
+        for record in self.recorder.records:
+            total = totals.setdefault(record['stage'], {'calls': 0, 'seconds': 0.0, 'rows': 0, 'peak_rss_mb': None, 'peak_tracemalloc_mb': None})
+            total['calls'] += 1
+            total['seconds'] += record['seconds']
+            total['rows'] += record['rows']
+            for key in ('peak_rss_mb', 'peak_tracemalloc_mb'):
+                if record[key] is not None:
+                    total[key] = max(total[key] or 0, record[key])
+        for total in totals.values():
+            total['rows_per_sec'] = total['rows'] / total['seconds'] if total['seconds'] > 0 else None
+        return totals
+
+    def to_dict(self):
+        elapsed = time.perf_counter() - self.start_time
+        rows = sum(stats['rows'] for stats in self.tables.values())
+        return {
+            'meta': self.meta,
+            'elapsed_seconds': elapsed,
+            'rows': rows,
+            'rows_per_sec': rows / elapsed if elapsed > 0 else None,
+            'peak_rss_mb': peak_rss_mb(),
+            'tables': {
+                table_name: {'rows': stats['rows'], 'bytes_per_row': stats['bytes'] / max(stats['rows'], 1)}
+                for table_name, stats in self.tables.items()
+            },
+            'stages': self.stage_totals(),
+            'stage_records': self.recorder.records
+        }
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+def print_progress(progress):
+    """
+    Default progress callback, one line per report
+    """
+    eta = f", eta {progress['eta_seconds']:.0f}s" if progress['eta_seconds'] is not None else ''
+    print(
+        f"shard {progress['shards_done']}/{progress['n_shards']}: "
+        f"{progress['persons_done']}/{progress['n_persons']} persons, {progress['rows']} rows, "
+        f"{progress['elapsed_seconds']:.1f}s{eta}..."
+    )
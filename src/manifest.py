@@ -0,0 +1,148 @@
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+
+"""
+Run manifest of a generated dataset
+Records what has been generated so far (seed entropy, person shard layout, next row ids, visit window),
+so a later run can generate only the delta and append it, carrying on the ids and seed streams.
+A run in progress also has a checkpoint (planned shards, shards done, next ids, sink state) that is
+saved after every written shard, so an interrupted run can be resumed.
+Each person's last visit_occurrence_id is kept in a .npy file next to the manifest, indexed by
+person_id - ID_START, so visits appended later link to the person's earlier visits.
+"""
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+# per shard (person_id, last visit_occurrence_id) pairs of the run in progress, merged when the run finishes
+VISIT_LINKS_DIR = 'visit_links'
+
+def manifest_path(output_dir):
+    return os.path.join(output_dir, MANIFEST_NAME)
+
+def new_manifest(entropy, shard_size, definitions_path, reference_year=None, tables=None, output=None):
+    """
+    Empty manifest for a dataset generated from seed entropy with shards of shard_size persons
+    definitions_path is None for the default definitions, which are found relative to the repo
+    reference_year is the year ages are drawn relative to, kept so later runs redraw the same birth years
+    tables are the tables of the dataset, None for all, later runs generate the same tables
+    output is the output format and sink options ({'format': ..., 'options': {...}}), later runs write
+    to the dataset with the same sink
+    """
+    return {
+        'version': MANIFEST_VERSION,
+        'entropy': entropy,
+        'shard_size': shard_size,
+        'definitions_path': definitions_path,
+        'reference_year': reference_year if reference_year is not None else datetime.now().year,
+        'tables': tables,
+        'output': output,
+        'n_persons': 0,
+        'n_visits': 0,
+        'next_ids': {},
+        'next_shard': 0,
+        'person_shards': [],
+        'visit_window': None,
+        'runs': []
+    }
+
+def record_run(manifest, shards, next_ids, visit_window, rows):
+    """
+    Add a finished run to the manifest: its shards, the ids to carry on from and the rows it wrote
+    """
+    new_shards = [shard for shard in shards if shard['new_persons']]
+    manifest['person_shards'].extend(
+        {'shard': shard['shard'], 'person_start_id': shard['person_start_id'], 'n_persons': shard['n_persons']}
+        for shard in new_shards
+    )
+    manifest['n_persons'] += sum(shard['n_persons'] for shard in new_shards)
+    manifest['n_visits'] += sum(shard['n_visits'] for shard in shards)
+    manifest['next_ids'] = dict(next_ids)
+    manifest['next_shard'] = max([manifest['next_shard']] + [shard['shard'] + 1 for shard in shards])
+    manifest['visit_window'] = list(visit_window)
+    manifest['runs'].append({
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'n_persons': sum(shard['n_persons'] for shard in new_shards),
+        'n_visits': sum(shard['n_visits'] for shard in shards),
+        'visit_window': list(visit_window),
+        'rows': rows
+    })
+    return manifest
+
+def save_shard_last_visits(manifest_path, shard, person_ids, visit_ids):
+    """
+    Save the last visit of every person with visits in a shard, person_ids and visit_ids being
+    the visit table columns in person then date order
+    """
+    links_dir = os.path.join(os.path.dirname(manifest_path), VISIT_LINKS_DIR)
+    os.makedirs(links_dir, exist_ok=True)
+    person_ids = np.asarray(person_ids, dtype=np.int64)
+    last = np.ones(len(person_ids), dtype=bool)
+    last[:-1] = person_ids[1:] != person_ids[:-1]
+    np.save(os.path.join(links_dir, f"shard-{shard}.npy"), np.stack([person_ids[last], np.asarray(visit_ids, dtype=np.int64)[last]]))
+
+def last_visits_path(manifest, manifest_path):
+    """
+    File of each person's last visit_occurrence_id over the recorded runs, None before any visits
+    """
+    if manifest.get('last_visits') is None:
+        return None
+    return os.path.join(os.path.dirname(manifest_path), manifest['last_visits'])
+
+def merge_last_visits(manifest, manifest_path, shards, n_persons, id_start):
+    """
+    Write the last visits of the recorded runs updated with the saved shards of the finished run to
+    a new file and point the manifest at it. The previous file and the shard files are left in place
+    until the manifest is saved, see remove_merged_last_visits, so a crash in between can merge again
+    """
+    last_visits = np.zeros(n_persons, dtype=np.int64)
+    previous_path = last_visits_path(manifest, manifest_path)
+    if previous_path is not None:
+        previous = np.load(previous_path)
+        last_visits[:len(previous)] = previous
+    links_dir = os.path.join(os.path.dirname(manifest_path), VISIT_LINKS_DIR)
+    for shard in shards:
+        shard_path = os.path.join(links_dir, f"shard-{shard['shard']}.npy")
+        if os.path.exists(shard_path):
+            person_ids, visit_ids = np.load(shard_path)
+            last_visits[person_ids - id_start] = visit_ids
+    name = f"last_visits-{len(manifest['runs'])}.npy"
+    np.save(os.path.join(os.path.dirname(manifest_path), name), last_visits)
+    manifest['last_visits'] = name
+
+def remove_merged_last_visits(manifest, manifest_path):
+    """
+    Remove the shard files and every last visits file but the manifest's once the merged file is saved
+    """
+    output_dir = os.path.dirname(manifest_path)
+    links_dir = os.path.join(output_dir, VISIT_LINKS_DIR)
+    if os.path.isdir(links_dir):
+        for name in os.listdir(links_dir):
+            os.remove(os.path.join(links_dir, name))
+        os.rmdir(links_dir)
+    for name in os.listdir(output_dir or '.'):
+        if name.startswith('last_visits-') and name.endswith('.npy') and name != manifest.get('last_visits'):
+            os.remove(os.path.join(output_dir, name))
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"no manifest at {path}, run a full generation first")
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError(f"{path}: unsupported manifest version {manifest.get('version')}")
+    return manifest
+
+def save_manifest(manifest, path):
+    """
+    Write the manifest atomically, a crash mid-write leaves the previous manifest in place
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
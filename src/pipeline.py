@@ -0,0 +1,463 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from src.concepts import DEFINITIONS_PATH, load_concept_model
+from src.datagen import VISIT_WINDOW, generate_person_ids, generate_person_table, generate_person_profiles, generate_visit_table, generate_condition_table, generate_measurement_table, generate_drug_exposure_table, build_person_visit_index
+from src.instrumentation import RunReport, StageRecorder
+from src.manifest import load_manifest, new_manifest, record_run, save_manifest, save_shard_last_visits, last_visits_path, merge_last_visits, remove_merged_last_visits
+from src.schema import TABLE_COLUMNS, FOREIGN_KEYS
+
+"""
+Sharded generation pipeline
+Persons are processed in fixed-size shards and every table is generated per shard, so peak memory
+depends on the shard size rather than the cohort size. Row ids run on across shards, keeping them
+globally unique and contiguous.
+Each shard draws from its own numpy Generator spawned from one master seed, so shards can be
+generated in parallel and the output for a given seed and shard_size does not depend on worker count.
+A run can record a manifest, checkpointed after every shard so resume_pipeline can finish an
+interrupted run, which extend_pipeline reads to append new persons and visits to the dataset,
+with ids and seed streams carrying on from the previous run.
+"""
+
+ID_START = 1000000000
+
+# event tables have no fixed size per shard, so their ids are offset once earlier shards are generated
+EVENT_ID_COLUMNS = {
+    'condition_occurrence': 'condition_occurrence_id',
+    'drug_exposure': 'drug_exposure_id',
+    'measurement': 'measurement_id'
+}
+
+def resolve_tables(tables=None):
+    """
+    Tables to generate in TABLE_COLUMNS order: the requested tables plus every table they reference,
+    so the output keeps its foreign keys. None for all tables
+    """
+    if tables is None:
+        return list(TABLE_COLUMNS)
+    unknown = set(tables) - set(TABLE_COLUMNS)
+    if unknown:
+        raise ValueError(f"unknown tables: {sorted(unknown)}")
+
+    selected = set(tables)
+    while True:
+        referenced = {ref_table for table_name, _, ref_table, _ in FOREIGN_KEYS if table_name in selected}
+        if referenced <= selected:
+            return [table_name for table_name in TABLE_COLUMNS if table_name in selected]
+        selected |= referenced
+
+def plan_person_shards(n_persons, shard_size, person_start_id=ID_START, first_shard=0):
+    """
+    Split n_persons new persons into shards of at most shard_size persons
+    shard is the shard's seed position, so shards of later runs continue from first_shard
+    """
+    shards = []
+    for person_start in range(0, n_persons, shard_size):
+        person_stop = min(person_start + shard_size, n_persons)
+        shards.append({
+            'shard': first_shard + len(shards),
+            'profile_shard': first_shard + len(shards),
+            'new_persons': True,
+            'n_persons': person_stop - person_start,
+            'person_start_id': person_start_id + person_start
+        })
+    return shards
+
+def assign_visits(shards, n_visits, visit_start_id=ID_START, visit_window=VISIT_WINDOW, reference_year=None):
+    """
+    Split n_visits over shards in proportion to their persons so the shards add up to exactly n_visits
+    reference_year is the year person ages are drawn relative to, None for the current year
+    """
+    n_persons = sum(shard['n_persons'] for shard in shards)
+    persons_done = 0
+    for shard in shards:
+        visit_start = n_visits * persons_done // n_persons
+        persons_done += shard['n_persons']
+        visit_stop = n_visits * persons_done // n_persons
+        shard.update({
+            'n_visits': visit_stop - visit_start,
+            'visit_start_id': visit_start_id + visit_start,
+            'visit_window': tuple(visit_window),
+            'reference_year': reference_year
+        })
+    return shards
+
+def plan_shards(n_persons, n_visits, shard_size, reference_year=None):
+    """
+    Split the cohort into shards of at most shard_size persons
+    Visits are split in proportion to shard size so the shards add up to exactly n_visits
+    Returns list of dicts with the person and visit count and first id of each shard
+    """
+    return assign_visits(plan_person_shards(n_persons, shard_size), n_visits, reference_year=reference_year)
+
+def plan_delta_shards(manifest, n_persons, n_visits, visit_window):
+    """
+    Shards adding n_persons new persons and n_visits new visits to the dataset described by manifest
+    Existing persons are revisited in their original shards, which keeps the person ranges their profiles
+    were drawn for, new persons follow in shards of the manifest shard_size
+    Visits are split over existing and new persons alike, shards left without visits are dropped
+    """
+    next_shard = manifest['next_shard']
+    shards = []
+    for person_shard in manifest['person_shards']:
+        shards.append({
+            'shard': next_shard + len(shards),
+            'profile_shard': person_shard['shard'],
+            'new_persons': False,
+            'n_persons': person_shard['n_persons'],
+            'person_start_id': person_shard['person_start_id']
+        })
+    shards += plan_person_shards(
+        n_persons,
+        manifest['shard_size'],
+        manifest['next_ids']['person'],
+        next_shard + len(shards)
+    )
+    if not shards:
+        return []
+    # manifests written before reference_year was recorded fall back to the current year
+    assign_visits(shards, n_visits, manifest['next_ids']['visit_occurrence'], visit_window, manifest.get('reference_year'))
+    return [shard for shard in shards if shard['new_persons'] or shard['n_visits'] > 0]
+
+def manifest_definitions_path(manifest):
+    """
+    Definitions file of the dataset described by manifest, which records None for the default definitions
+    so the dataset does not depend on where the repo is checked out
+    """
+    return manifest['definitions_path'] or DEFINITIONS_PATH
+
+def shard_seed(entropy, shard):
+    """
+    SeedSequence of the shard at seed position shard, the same stream SeedSequence(entropy).spawn gives
+    """
+    return np.random.SeedSequence(entropy, spawn_key=(shard,))
+
+def profile_seed(seed_seq):
+    """
+    Child SeedSequence for the person profiles of a shard, a stream separate from the table draws
+    so the profiles of a shard's persons can be redrawn without replaying its tables
+    """
+    return np.random.SeedSequence(seed_seq.entropy, spawn_key=seed_seq.spawn_key + (0,))
+
+def generate_shard(shard, entropy, recorder_options=None, definitions_path=DEFINITIONS_PATH, tables=None):
+    """
+    Generate all OMOP tables for one shard using its own Generator, seeded from the master seed entropy
+    Person profiles (birth year, disease cluster) come first, from the shard the persons were created in,
+    so shards revisiting existing persons redraw the same profiles and add visits and events only,
+    the person table is only generated for new persons, shard['last_visits'] (a file of every person's last
+    visit, see manifest.merge_last_visits) links their first new visits to their earlier ones
+    Event table ids start at ID_START and are offset by the caller once earlier shard sizes are known
+    Returns (tables, stage records), recorder_options are passed to the StageRecorder timing each stage
+    definitions_path is compiled once per process and shared by every shard the process generates
+    tables (see resolve_tables) limits the generated tables, generators of other tables are skipped
+    """
+    recorder = StageRecorder(**(recorder_options or {}))
+    tables_wanted = resolve_tables(tables)
+    n = shard['shard']
+    rng = np.random.default_rng(shard_seed(entropy, n))
+    concepts = load_concept_model(definitions_path)
+    person_ids = generate_person_ids(shard['n_persons'], shard['person_start_id'])
+    tables = {}
+
+    # latent person profiles (birth year, disease cluster), drawn once and shared by every generator
+    with recorder.stage('person_profile', n) as record:
+        profile_rng = np.random.default_rng(profile_seed(shard_seed(entropy, shard['profile_shard'])))
+        profiles = generate_person_profiles(person_ids, profile_rng, concepts, shard.get('reference_year'))
+        record['rows'] = len(person_ids)
+
+    if shard['new_persons'] and 'person' in tables_wanted:
+        with recorder.stage('person', n) as record:
+            tables['person'] = generate_person_table(person_ids, rng=rng, concepts=concepts, profiles=profiles)
+            record['rows'] = len(tables['person'])
+
+    # event tables reference visits, so resolve_tables always includes visits when events are wanted
+    if 'visit_occurrence' not in tables_wanted:
+        return tables, recorder.records
+
+    # last visits of the shard's persons from earlier runs, for shards revisiting existing persons
+    previous_visit_ids = None
+    if shard.get('last_visits') is not None:
+        last_visits = np.load(shard['last_visits'], mmap_mode='r')
+        start = shard['person_start_id'] - ID_START
+        previous_visit_ids = np.array(last_visits[start:start + shard['n_persons']])
+
+    with recorder.stage('visit_occurrence', n) as record:
+        visit_df = generate_visit_table(
+            person_ids,
+            shard['n_visits'],
+            shard['visit_start_id'],
+            rng=rng,
+            concepts=concepts,
+            visit_window=shard['visit_window'],
+            birth_years=profiles.year_of_birth,
+            previous_visit_ids=previous_visit_ids
+        )
+        tables['visit_occurrence'] = visit_df
+        record['rows'] = len(visit_df)
+
+    # person -> visit index, built once and shared by the event generators
+    with recorder.stage('visit_index', n) as record:
+        visit_index = build_person_visit_index(person_ids, visit_df)
+        record['rows'] = len(visit_df)
+
+    event_generators = {
+        'condition_occurrence': (generate_condition_table, {'profiles': profiles}),
+        'drug_exposure': (generate_drug_exposure_table, {'profiles': profiles}),
+        'measurement': (generate_measurement_table, {})
+    }
+    for table_name, (generator, options) in event_generators.items():
+        if table_name not in tables_wanted:
+            continue
+        with recorder.stage(table_name, n) as record:
+            tables[table_name] = generator(person_ids, visit_df, visit_index, rng=rng, concepts=concepts, **options)
+            record['rows'] = len(tables[table_name])
+
+    return tables, recorder.records
+
+def generate_shards(n_persons, n_visits, shard_size=100000, seed=None, workers=1, recorder_options=None, definitions_path=DEFINITIONS_PATH, tables=None):
+    """
+    Yield (shard, tables, stage records) one shard at a time, in shard order
+    With workers > 1 shards are generated in a process pool, keeping at most 2 x workers shards in flight
+    """
+    shards = plan_shards(n_persons, n_visits, shard_size)
+    entropy = np.random.SeedSequence(seed).entropy
+    next_ids = {table_name: ID_START for table_name in EVENT_ID_COLUMNS}
+    yield from generate_planned_shards(shards, entropy, next_ids, workers, recorder_options, definitions_path, tables)
+
+def generate_planned_shards(shards, entropy, next_ids, workers=1, recorder_options=None, definitions_path=DEFINITIONS_PATH, tables=None):
+    """
+    Yield (shard, tables, stage records) for planned shards, in shard order
+    next_ids maps each event table to its next free id and is advanced in place as shards are yielded
+    """
+    # compile up front so a bad definitions file fails before any worker starts
+    load_concept_model(definitions_path)
+
+    for shard, (tables, records) in _generate_in_order(shards, entropy, workers, recorder_options, definitions_path, tables):
+        # event tables have no fixed size per shard, so their ids carry on from the previous shard
+        for table_name in [table_name for table_name in EVENT_ID_COLUMNS if table_name in tables]:
+            tables[table_name][EVENT_ID_COLUMNS[table_name]] += next_ids[table_name] - ID_START
+            next_ids[table_name] += len(tables[table_name])
+        yield shard, tables, records
+
+def _generate_in_order(shards, entropy, workers, recorder_options=None, definitions_path=DEFINITIONS_PATH, tables=None):
+    """
+    Generate shards in-process or in a process pool, yielding results in shard order
+    """
+    if workers <= 1:
+        for shard in shards:
+            yield shard, generate_shard(shard, entropy, recorder_options, definitions_path, tables)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for shard in shards:
+            pending.append((shard, pool.submit(generate_shard, shard, entropy, recorder_options, definitions_path, tables)))
+            # bound the number of finished shards waiting to be written
+            if len(pending) >= 2 * workers:
+                shard_done, future = pending.popleft()
+                yield shard_done, future.result()
+        while pending:
+            shard_done, future = pending.popleft()
+            yield shard_done, future.result()
+
+def _write_checkpointed(manifest, manifest_path, sink, workers, report):
+    """
+    Generate the shards of the run in manifest['checkpoint'] that are not done yet, writing each one to
+    sink as it arrives. With a manifest_path the checkpoint (shards done, next ids, sink state) is saved
+    after every written shard, so an interrupted run can be resumed from the last finished shard
+    Once all shards are written the sink is closed and the run is recorded in the manifest
+    """
+    checkpoint = manifest['checkpoint']
+    shards = checkpoint['shards']
+    n_persons = sum(shard['n_persons'] for shard in shards)
+    persons_done = sum(shard['n_persons'] for shard in shards[:checkpoint['shards_done']])
+    next_ids = dict(checkpoint['next_ids'])
+    link_visits = manifest_path is not None and 'visit_occurrence' in resolve_tables(manifest.get('tables'))
+
+    # shards revisiting existing persons link their first new visits to the persons' last recorded visits
+    pending = shards[checkpoint['shards_done']:]
+    previous_path = last_visits_path(manifest, manifest_path) if link_visits else None
+    if previous_path is not None:
+        pending = [shard if shard['new_persons'] else {**shard, 'last_visits': previous_path} for shard in pending]
+
+    generated = generate_planned_shards(
+        pending,
+        manifest['entropy'],
+        next_ids,
+        workers,
+        report.recorder.options(),
+        manifest_definitions_path(manifest),
+        manifest.get('tables')
+    )
+    for shard, tables, records in generated:
+        report.add_shard(shard, tables, records)
+        for table_name, df in tables.items():
+            with report.recorder.stage(f"write {table_name}", shard['shard']) as record:
+                sink.write(table_name, df)
+                record['rows'] = len(df)
+            checkpoint['rows'][table_name] = checkpoint['rows'].get(table_name, 0) + len(df)
+        checkpoint['shards_done'] += 1
+        checkpoint['next_ids'] = dict(next_ids)
+        if link_visits and 'visit_occurrence' in tables:
+            visit_df = tables['visit_occurrence']
+            save_shard_last_visits(manifest_path, shard['shard'], visit_df['person_id'], visit_df['visit_occurrence_id'])
+        if manifest_path is not None:
+            # sinks that write in the background (csv) finish the shard here
+            with report.recorder.stage('checkpoint', shard['shard']) as record:
+                record['rows'] = sum(len(df) for df in tables.values())
+                checkpoint['sink'] = sink.checkpoint()
+                save_manifest(manifest, manifest_path)
+        persons_done += shard['n_persons']
+        report.shard_done(checkpoint['shards_done'], len(shards), persons_done, n_persons)
+
+    with report.recorder.stage('close sink'):
+        sink.close()
+
+    run_next_ids = _next_ids(shards, next_ids, manifest['next_ids'].get('person', ID_START), manifest['next_ids'].get('visit_occurrence', ID_START))
+    if link_visits:
+        merge_last_visits(manifest, manifest_path, shards, run_next_ids['person'] - ID_START, ID_START)
+    record_run(manifest, shards, run_next_ids, checkpoint['visit_window'], checkpoint['rows'])
+    del manifest['checkpoint']
+    if manifest_path is not None:
+        save_manifest(manifest, manifest_path)
+    if link_visits:
+        remove_merged_last_visits(manifest, manifest_path)
+    return report.to_dict()
+
+def _start_checkpoint(manifest, manifest_path, mode, shards, next_ids, visit_window, sink, workers=1):
+    """
+    Record the planned run in the manifest before the first shard is written
+    workers is kept so a resumed run uses the same number of workers unless told otherwise
+    """
+    manifest['checkpoint'] = {
+        'mode': mode,
+        'workers': workers,
+        'shards': shards,
+        'shards_done': 0,
+        'next_ids': dict(next_ids),
+        'visit_window': list(visit_window),
+        'rows': {},
+        'sink': sink.checkpoint() if manifest_path is not None else None
+    }
+    if manifest_path is not None:
+        save_manifest(manifest, manifest_path)
+
+def _next_ids(shards, next_ids, person_id, visit_id):
+    """
+    Next free id of every table after shards, starting from person_id / visit_id for the planned tables
+    """
+    for shard in shards:
+        person_id = max(person_id, shard['person_start_id'] + shard['n_persons'])
+        visit_id = max(visit_id, shard['visit_start_id'] + shard['n_visits'])
+    return {'person': person_id, 'visit_occurrence': visit_id, **next_ids}
+
+def run_pipeline(n_persons, n_visits, sink, shard_size=100000, seed=None, workers=1, report=None, definitions_path=DEFINITIONS_PATH, manifest_path=None, tables=None, output=None):
+    """
+    Generate the cohort shard by shard and write every shard to sink
+    report (RunReport) collects stage timings and progress, a default one is created if not given
+    definitions_path is the concept definitions file (JSON or YAML) the generators sample from
+    manifest_path checkpoints the run after every shard, so resume_pipeline can finish it if interrupted,
+    and records the finished run so extend_pipeline can append to the dataset later
+    tables limits the generated tables (see resolve_tables), output of other tables from a previous run
+    is removed so the dataset stays consistent. Without visit_occurrence no visits are generated
+    output ({'format': ..., 'options': {...}}) describes sink, it is recorded in the manifest so resumed
+    and appending runs can write with the same sink
+    Returns the run report as a dict (see RunReport.to_dict)
+    """
+    # fail on invalid definitions before any output or checkpoint is touched
+    load_concept_model(definitions_path)
+    tables = resolve_tables(tables)
+    if 'visit_occurrence' not in tables:
+        n_visits = 0
+    # referencing tables first, so no cleared table is still referenced
+    for table_name in reversed(TABLE_COLUMNS):
+        if table_name not in tables:
+            sink.clear(table_name)
+
+    if report is None:
+        report = RunReport()
+    report.meta.update({
+        'mode': 'full',
+        'n_persons': n_persons,
+        'n_visits': n_visits,
+        'shard_size': shard_size,
+        'seed': seed,
+        'workers': workers,
+        'definitions_path': definitions_path,
+        'tables': tables
+    })
+
+    recorded_definitions = None if os.path.abspath(definitions_path) == DEFINITIONS_PATH else definitions_path
+    manifest = new_manifest(np.random.SeedSequence(seed).entropy, shard_size, recorded_definitions, tables=tables, output=output)
+    shards = plan_shards(n_persons, n_visits, shard_size, manifest['reference_year'])
+    next_ids = {table_name: ID_START for table_name in EVENT_ID_COLUMNS}
+    _start_checkpoint(manifest, manifest_path, 'full', shards, next_ids, VISIT_WINDOW, sink, workers)
+    return _write_checkpointed(manifest, manifest_path, sink, workers, report)
+
+def extend_pipeline(manifest_path, n_persons, n_visits, sink, workers=1, report=None, window_days=365):
+    """
+    Append n_persons new persons and n_visits new visits to the dataset recorded in manifest_path
+    Visits go to existing and new persons alike and start in the window_days after the previous
+    run's visit window, conditions, drugs and measurements are generated for the new visits only
+    sink should be opened in append mode, the run is checkpointed like run_pipeline
+    The tables of the dataset are extended, a dataset without visit_occurrence only gets new persons
+    Returns the run report as a dict (see RunReport.to_dict)
+    """
+    manifest = load_manifest(manifest_path)
+    if 'checkpoint' in manifest:
+        raise ValueError(f"{manifest_path}: the previous run did not finish, resume it before appending")
+    load_concept_model(manifest_definitions_path(manifest))
+    if 'visit_occurrence' not in resolve_tables(manifest.get('tables')):
+        n_visits = 0
+    window_start = np.datetime64(manifest['visit_window'][1], 'D')
+    visit_window = (str(window_start), str(window_start + window_days))
+
+    if report is None:
+        report = RunReport()
+    report.meta.update({
+        'mode': 'append',
+        'n_persons': n_persons,
+        'n_visits': n_visits,
+        'visit_window': list(visit_window),
+        'shard_size': manifest['shard_size'],
+        'workers': workers,
+        'definitions_path': manifest_definitions_path(manifest)
+    })
+
+    shards = plan_delta_shards(manifest, n_persons, n_visits, visit_window)
+    next_ids = {table_name: manifest['next_ids'][table_name] for table_name in EVENT_ID_COLUMNS}
+    _start_checkpoint(manifest, manifest_path, 'append', shards, next_ids, visit_window, sink, workers)
+    return _write_checkpointed(manifest, manifest_path, sink, workers, report)
+
+def resume_pipeline(manifest_path, sink, workers=None, report=None):
+    """
+    Finish an interrupted run_pipeline or extend_pipeline run from its last checkpoint
+    sink should be opened in append mode, it is first rolled back to the checkpoint to drop any
+    partly written shard, so the output is identical to an uninterrupted run
+    workers defaults to the workers the interrupted run was planned with
+    Returns the run report as a dict (see RunReport.to_dict)
+    """
+    manifest = load_manifest(manifest_path)
+    checkpoint = manifest.get('checkpoint')
+    if checkpoint is None:
+        raise ValueError(f"{manifest_path}: no interrupted run to resume")
+    # checkpoints written before workers were recorded resume in-process
+    if workers is None:
+        workers = checkpoint.get('workers', 1)
+
+    if report is None:
+        report = RunReport()
+    report.meta.update({
+        'mode': f"resume {checkpoint['mode']}",
+        'shards_done': checkpoint['shards_done'],
+        'n_shards': len(checkpoint['shards']),
+        'shard_size': manifest['shard_size'],
+        'workers': workers,
+        'definitions_path': manifest_definitions_path(manifest)
+    })
+
+    sink.restore(checkpoint['sink'])
+    return _write_checkpointed(manifest, manifest_path, sink, workers, report)
@@ -0,0 +1,226 @@
+import math
+import os
+
+"""
+Run planner
+Estimates the rows of every table from the requested persons and visits and the concept definitions,
+then the peak memory and run time from per-row costs calibrated with benchmark_omop.py, and picks the
+shard size and worker count. Nothing is generated, so a plan is cheap enough to print before every run.
+Costs were calibrated on a single core x86_64 machine, expect times to scale with single core speed.
+"""
+
+# named cohort sizes, persons and visits
+PRESETS = {
+    'dev': {'n_persons': 1000, 'n_visits': 5000},
+    'ci': {'n_persons': 10000, 'n_visits': 50000},
+    'load-test': {'n_persons': 1000000, 'n_visits': 10000000},
+    '100m': {'n_persons': 10000000, 'n_visits': 100000000}
+}
+
+# generation seconds per row of each table, the person cost includes drawing the person profile
+GENERATE_SECONDS_PER_ROW = {
+    'person': 0.65e-6,
+    'visit_occurrence': 0.65e-6,
+    'condition_occurrence': 0.16e-6,
+    'drug_exposure': 0.17e-6,
+    'measurement': 0.22e-6
+}
+# write seconds per row of any table
+WRITE_SECONDS_PER_ROW = {
+    'csv': 0.9e-6,
+    'parquet': 0.3e-6,
+    'duckdb': 4.5e-6
+}
+
+# peak bytes per generated row of a shard while it is generated, intermediates included
+GENERATE_BYTES_PER_ROW = 220
+# bytes per row of a finished shard waiting to be written (or of the previous shard, still referenced)
+HELD_BYTES_PER_ROW = 40
+# extra bytes per row of a shard while it is written, and fixed extra memory of the sink
+WRITE_BYTES_PER_ROW = {
+    'csv': 80,
+    'parquet': 15,
+    'duckdb': 45
+}
+WRITE_BASE_MB = {
+    'csv': 0,
+    'parquet': 20,
+    'duckdb': 170
+}
+# resident memory of a process with the generators imported
+BASE_MB = 170
+
+# shards are sized for this many rows, so peak memory per worker stays near 1-1.5GB whatever the cohort size
+TARGET_SHARD_ROWS = 5000000
+# rows per visit over all tables with the default definitions (visit, 2 conditions, 1.5 drugs, 3.2 measurements)
+# shards are sized with this whatever the tables and definitions, so output for a seed depends on persons and visits only
+SHARD_ROWS_PER_VISIT = 7.7
+MIN_SHARD_SIZE = 1000
+# fraction of the available memory a plan may use
+MEMORY_HEADROOM = 0.8
+# largest id the DDL integer type holds, parquet and duckdb output are typed by the DDL
+INTEGER_MAX = 2 ** 31 - 1
+
+def available_memory_mb():
+    """
+    Memory available to new processes in MB, None if it cannot be read on this platform
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 2
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def estimate_rows(n_persons, n_visits, concepts, tables=None):
+    """
+    Expected rows of every generated table, from the per visit event counts and the concept definitions
+    tables is a resolved table list (see pipeline.resolve_tables), None for all
+    """
+    from src.datagen import CONDITIONS_PER_VISIT, DRUGS_PER_VISIT
+
+    rows = {
+        'person': n_persons,
+        'visit_occurrence': n_visits,
+        'condition_occurrence': n_visits * sum(CONDITIONS_PER_VISIT) / 2,
+        'drug_exposure': n_visits * sum(DRUGS_PER_VISIT) / 2,
+        'measurement': n_visits * float(concepts.measurement_probabilities.sum())
+    }
+    return {table_name: int(round(n)) for table_name, n in rows.items() if tables is None or table_name in tables}
+
+def choose_shard_size(n_persons, n_visits):
+    """
+    Persons per shard giving about TARGET_SHARD_ROWS rows with all tables generated, rounded down to 1, 2 or 5 x 10^k
+    Depends on the persons and visits only, not the tables, definitions or machine, as output for a given
+    seed depends on the shard size
+    """
+    rows_per_person = 1 + SHARD_ROWS_PER_VISIT * n_visits / max(n_persons, 1)
+    shard_size = TARGET_SHARD_ROWS / rows_per_person
+    magnitude = 10 ** math.floor(math.log10(shard_size))
+    shard_size = max(step * magnitude for step in (1, 2, 5) if step * magnitude <= shard_size)
+    return int(min(max(shard_size, MIN_SHARD_SIZE), max(n_persons, 1)))
+
+def estimate_peak_memory_mb(shard_rows, workers, output_format='csv'):
+    """
+    Peak memory of a run over all processes, shard_rows being the rows generated per shard
+    With workers > 1 each worker generates a shard while the main process holds up to 2 x workers
+    finished shards and writes one of them
+    """
+    write_mb = WRITE_BASE_MB[output_format] + shard_rows * WRITE_BYTES_PER_ROW[output_format] / 1024 ** 2
+    generate_mb = shard_rows * GENERATE_BYTES_PER_ROW / 1024 ** 2
+    if workers <= 1:
+        held_mb = shard_rows * HELD_BYTES_PER_ROW / 1024 ** 2
+        return BASE_MB + generate_mb + held_mb + write_mb
+    held_mb = 2 * workers * shard_rows * HELD_BYTES_PER_ROW / 1024 ** 2
+    return BASE_MB + held_mb + write_mb + workers * (BASE_MB + generate_mb)
+
+def estimate_seconds(rows, workers, output_format='csv'):
+    """
+    Run time of generating and writing rows (per table), writing overlaps generation with workers > 1
+    """
+    generate = sum(n * GENERATE_SECONDS_PER_ROW[table_name] for table_name, n in rows.items())
+    write = sum(rows.values()) * WRITE_SECONDS_PER_ROW[output_format]
+    if workers <= 1:
+        return generate + write
+    return max(generate / workers, write)
+
+def plan_run(n_persons, n_visits, output_format='csv', concepts=None, tables=None, shard_size=None,
+             workers=None, memory_limit_mb=None, cohort_persons=None, next_ids=None):
+    """
+    Plan a run: expected rows per table, shard size, workers, peak memory and run time
+    shard_size and workers are chosen when None, workers as many as the cores, shards and
+    memory_limit_mb (default MEMORY_HEADROOM x the available memory) allow
+    cohort_persons is the number of persons the visits are spread over, more than n_persons when appending
+    next_ids maps tables to their first id when appending (manifest next_ids), ids start at ID_START otherwise
+    Returns a dict, warnings lists anything likely to make the run fail, errors anything certain to
+    """
+    from src.concepts import load_concept_model
+    from src.pipeline import ID_START, resolve_tables
+
+    if output_format not in WRITE_SECONDS_PER_ROW:
+        raise ValueError(f"unknown output format: {output_format}")
+    concepts = concepts or load_concept_model()
+    tables = resolve_tables(tables)
+    cohort_persons = max(cohort_persons or n_persons, 1)
+    if shard_size is None:
+        shard_size = choose_shard_size(cohort_persons, n_visits)
+    if 'visit_occurrence' not in tables:
+        n_visits = 0
+    rows = estimate_rows(n_persons, n_visits, concepts, tables)
+    rows_per_person = (sum(rows.values()) - rows.get('person', 0)) / cohort_persons + ('person' in tables)
+
+    n_shards = math.ceil(cohort_persons / shard_size)
+    shard_rows = int(min(shard_size, cohort_persons) * rows_per_person)
+
+    if memory_limit_mb is None:
+        available = available_memory_mb()
+        memory_limit_mb = available * MEMORY_HEADROOM if available is not None else None
+    if workers is None:
+        workers = max(1, min(os.cpu_count() or 1, n_shards))
+        # drop workers until the run fits in memory
+        while workers > 1 and memory_limit_mb is not None and estimate_peak_memory_mb(shard_rows, workers, output_format) > memory_limit_mb:
+            workers -= 1
+
+    peak_memory_mb = estimate_peak_memory_mb(shard_rows, workers, output_format)
+    warnings = []
+    errors = []
+    # ids run on from ID_START (or the previous run), parquet and duckdb cannot store ids past the DDL integer
+    # type, csv output can but does not load into the validate_omop.sql tables
+    for table_name, n in rows.items():
+        last_id = (next_ids or {}).get(table_name, ID_START) + n - 1
+        if last_id > INTEGER_MAX:
+            message = (
+                f"{table_name} ids would reach ~{last_id:,}, past the DDL integer type ({INTEGER_MAX:,})"
+            )
+            if output_format == 'csv':
+                warnings.append(f"{message}, the csv files will not load into the validate_omop.sql tables")
+            else:
+                errors.append(f"{message}, {output_format} output cannot store them")
+    if memory_limit_mb is not None and peak_memory_mb > memory_limit_mb:
+        warnings.append(
+            f"estimated peak memory {peak_memory_mb:,.0f}MB exceeds the {memory_limit_mb:,.0f}MB limit, "
+            f"use a smaller shard size or fewer workers"
+        )
+
+    return {
+        'n_persons': n_persons,
+        'n_visits': n_visits,
+        'output_format': output_format,
+        'tables': tables,
+        'rows': rows,
+        'shard_size': shard_size,
+        'n_shards': n_shards,
+        'shard_rows': shard_rows,
+        'workers': workers,
+        'peak_memory_mb': round(peak_memory_mb),
+        'memory_limit_mb': round(memory_limit_mb) if memory_limit_mb is not None else None,
+        'seconds': round(estimate_seconds(rows, workers, output_format), 1),
+        'warnings': warnings,
+        'errors': errors
+    }
+
+def format_plan(plan):
+    """
+    Plain text plan, rows per table then shards, workers, memory and time
+    """
+    lines = [f"{table_name}: ~{n:,} rows" for table_name, n in plan['rows'].items()]
+    lines.append(f"total: ~{sum(plan['rows'].values()):,} rows ({plan['output_format']})")
+    lines.append(f"{plan['n_shards']:,} shards of {plan['shard_size']:,} persons (~{plan['shard_rows']:,} rows each), {plan['workers']} workers")
+    limit = f" of {plan['memory_limit_mb']:,}MB available" if plan['memory_limit_mb'] is not None else ''
+    lines.append(f"estimated peak memory: {plan['peak_memory_mb']:,}MB{limit}")
+    lines.append(f"estimated run time: {_format_seconds(plan['seconds'])}")
+    lines += [f"WARNING {warning}" for warning in plan['warnings']]
+    lines += [f"ERROR {error}" for error in plan['errors']]
+    return '\n'.join(lines)
+
+def _format_seconds(seconds):
+    if seconds < 120:
+        return f"{seconds:.0f}s"
+    if seconds < 7200:
+        return f"{seconds / 60:.0f}min"
+    return f"{seconds / 3600:.1f}h"
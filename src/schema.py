@@ -0,0 +1,143 @@
+"""
+OMOP CDM 5.4 table definitions shared by the generation pipeline and exporters
+"""
+
+import os
+import re
+
+# reordering and checking for column existence
+# can replace with dataclasses
+TABLE_COLUMNS = {
+    'person': [
+        'person_id', 'gender_concept_id', 'year_of_birth', 'month_of_birth',
+        'day_of_birth', 'birth_datetime', 'race_concept_id', 'ethnicity_concept_id',
+        'location_id', 'provider_id', 'care_site_id', 'person_source_value',
+        'gender_source_value', 'gender_source_concept_id', 'race_source_value',
+        'race_source_concept_id', 'ethnicity_source_value', 'ethnicity_source_concept_id'
+    ],
+
+    'visit_occurrence': [
+        'visit_occurrence_id', 'person_id', 'visit_concept_id', 'visit_start_date',
+        'visit_start_datetime', 'visit_end_date', 'visit_end_datetime', 'visit_type_concept_id',
+        'provider_id', 'care_site_id', 'visit_source_value', 'visit_source_concept_id',
+        'admitted_from_concept_id', 'admitted_from_source_value', 'discharged_to_concept_id',
+        'discharged_to_source_value', 'preceding_visit_occurrence_id'
+    ],
+
+    'condition_occurrence': [
+        'condition_occurrence_id', 'person_id', 'condition_concept_id', 'condition_start_date',
+        'condition_start_datetime', 'condition_end_date', 'condition_end_datetime',
+        'condition_type_concept_id', 'condition_status_concept_id', 'stop_reason',
+        'provider_id', 'visit_occurrence_id', 'visit_detail_id', 'condition_source_value',
+        'condition_source_concept_id', 'condition_status_source_value'
+    ],
+
+    'drug_exposure': [
+        'drug_exposure_id', 'person_id', 'drug_concept_id', 'drug_exposure_start_date',
+        'drug_exposure_start_datetime', 'drug_exposure_end_date', 'drug_exposure_end_datetime',
+        'verbatim_end_date', 'drug_type_concept_id', 'stop_reason', 'refills', 'quantity',
+        'days_supply', 'sig', 'route_concept_id', 'lot_number', 'provider_id',
+        'visit_occurrence_id', 'visit_detail_id', 'drug_source_value',
+        'drug_source_concept_id', 'route_source_value', 'dose_unit_source_value'
+    ],
+
+    'measurement': [
+        'measurement_id', 'person_id', 'measurement_concept_id', 'measurement_date',
+        'measurement_datetime', 'measurement_time', 'measurement_type_concept_id',
+        'operator_concept_id', 'value_as_number', 'value_as_concept_id', 'unit_concept_id',
+        'range_low', 'range_high', 'provider_id', 'visit_occurrence_id', 'visit_detail_id',
+        'measurement_source_value', 'measurement_source_concept_id', 'unit_source_value',
+        'unit_source_concept_id', 'value_source_value', 'measurement_event_id',
+        'meas_event_field_concept_id'
+    ]
+}
+
+# column types come from the DDL in validate_omop.sql so exported files match the validated tables
+DDL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'validate_omop.sql')
+
+def load_ddl(path=DDL_PATH):
+    """
+    Parse the create table statements in validate_omop.sql
+    Returns dict of table name -> {'statement': create statement, 'columns': {column: (sql type, not null)},
+    'primary_key': column, 'foreign_keys': {column: (referenced table, referenced column)}}
+    """
+    with open(path) as f:
+        sql = f.read()
+
+    tables = {}
+    for match in re.finditer(r"create or replace table (\w+) \((.*?)\n\);", sql, re.DOTALL | re.IGNORECASE):
+        table_name, body = match.groups()
+        columns = {}
+        primary_key = None
+        foreign_keys = {}
+        for line in body.strip().split('\n'):
+            name, sql_type = line.split()[:2]
+            columns[name] = (re.sub(r"\(.*", "", sql_type).rstrip(',').lower(), 'not null' in line.lower())
+            if 'primary key' in line.lower():
+                primary_key = name
+            reference = re.search(r"references (\w+)\((\w+)\)", line, re.IGNORECASE)
+            if reference:
+                foreign_keys[name] = reference.groups()
+        tables[table_name] = {
+            'statement': match.group(0),
+            'columns': columns,
+            'primary_key': primary_key,
+            'foreign_keys': foreign_keys
+        }
+    return tables
+
+COLUMN_TYPES = {
+    table_name: {column: sql_type for column, (sql_type, _) in ddl['columns'].items()}
+    for table_name, ddl in load_ddl().items()
+}
+
+# (table, column, referenced table, referenced column) for every foreign key in the DDL
+FOREIGN_KEYS = [
+    (table_name, column, ref_table, ref_column)
+    for table_name, ddl in load_ddl().items()
+    for column, (ref_table, ref_column) in ddl['foreign_keys'].items()
+]
+
+# row id and person / visit link columns, kept as int64 in memory so they never wrap
+ID_COLUMNS = {
+    'person_id', 'visit_occurrence_id', 'preceding_visit_occurrence_id',
+    'condition_occurrence_id', 'drug_exposure_id', 'measurement_id'
+}
+
+def pandas_dtype(sql_type, column, not_null):
+    """
+    Compact pandas dtype for an OMOP column given its DDL type
+    concept ids are low cardinality so are stored as category, nullable integers use Int32/Int64
+    """
+    if column.endswith('_concept_id'):
+        return 'category'
+    if sql_type == 'integer':
+        if column in ID_COLUMNS:
+            return 'int64' if not_null else 'Int64'
+        return 'int32' if not_null else 'Int32'
+    if sql_type in ('date', 'timestamp'):
+        return 'datetime64[s]'
+    if sql_type == 'numeric':
+        return 'float32'
+    return 'string'
+
+TABLE_DTYPES = {
+    table_name: {
+        column: pandas_dtype(sql_type, column, not_null)
+        for column, (sql_type, not_null) in ddl['columns'].items()
+    }
+    for table_name, ddl in load_ddl().items()
+}
+
+def apply_schema(table_name, df):
+    """
+    Cast generated columns to the compact dtypes in TABLE_DTYPES, in OMOP column order
+    Columns that are always null are not materialised, exporters fill them in at write time
+    """
+    dtypes = TABLE_DTYPES[table_name]
+    unknown = set(df.columns) - set(dtypes)
+    if unknown:
+        raise ValueError(f"columns not in {table_name} schema: {sorted(unknown)}")
+
+    columns = [column for column in TABLE_COLUMNS[table_name] if column in df.columns]
+    return df[columns].astype({column: dtypes[column] for column in columns})
@@ -0,0 +1,337 @@
+import os
+
+import numpy as np
+
+from src.export import arrow_schema, csv_files
+from src.schema import TABLE_COLUMNS, load_ddl
+
+"""
+Streaming constraint validator for generated OMOP output (CSV, Parquet or DuckDB)
+Tables are read in Arrow batches and checked with vectorized NumPy operations, keeping memory bounded
+whatever the row count: primary keys and foreign keys are checked against bitmaps of one bit per id,
+and event dates against dense arrays of visit start/end days, built one window of visit ids at a time.
+Violations are counted per table and rule, with a few example row ids for each
+"""
+
+# in-row date order, (start column, end column)
+DATE_ORDER_COLUMNS = {
+    'visit_occurrence': ('visit_start_date', 'visit_end_date'),
+    'drug_exposure': ('drug_exposure_start_date', 'drug_exposure_end_date')
+}
+
+# event date that must fall within the visit it belongs to
+EVENT_DATE_COLUMNS = {
+    'condition_occurrence': 'condition_start_date',
+    'drug_exposure': 'drug_exposure_start_date',
+    'measurement': 'measurement_date'
+}
+
+MAX_EXAMPLES = 5
+
+class IdBitmap:
+    """
+    Set of integer ids stored as one bit per id over the range of ids added
+    the range grows as ids arrive, OMOP ids are 32 bit integers so it never exceeds 512MB
+    (125MB per billion contiguous ids)
+    """
+    def __init__(self):
+        self.start = 0
+        self.bits = np.zeros(0, dtype=np.uint8)
+        self.min_id = None
+        self.max_id = None
+
+    @property
+    def stop(self):
+        return self.start + 8 * len(self.bits)
+
+    def _cover(self, lo, hi):
+        """
+        Grow the bitmap to cover ids lo to hi, with some slack so growing ranges are not copied every batch
+        """
+        if len(self.bits) and lo >= self.start and hi < self.stop:
+            return
+        if len(self.bits):
+            lo, hi = min(lo, self.start), max(hi, self.stop - 1)
+        slack = (hi - lo) // 4
+        start = max(lo - slack, 0) // 8 * 8
+        bits = np.zeros((hi + slack - start) // 8 + 1, dtype=np.uint8)
+        offset = (self.start - start) // 8
+        bits[offset:offset + len(self.bits)] = self.bits
+        self.start, self.bits = start, bits
+
+    def contains(self, ids):
+        """
+        Boolean mask of the ids that are in the set
+        """
+        result = np.zeros(len(ids), dtype=bool)
+        inside = (ids >= self.start) & (ids < self.stop)
+        offsets = ids[inside] - self.start
+        result[inside] = (self.bits[offsets >> 3] >> (offsets & 7)) & 1
+        return result
+
+    def add(self, ids):
+        """
+        Add ids to the set, returning a boolean mask of the ids already present (earlier or within ids)
+        """
+        if len(ids) == 0:
+            return np.zeros(0, dtype=bool)
+        lo, hi = int(ids.min()), int(ids.max())
+        self._cover(lo, hi)
+        self.min_id = lo if self.min_id is None else min(self.min_id, lo)
+        self.max_id = hi if self.max_id is None else max(self.max_id, hi)
+
+        # sorting (cheap for ids that arrive in order) groups repeats and ids sharing a byte
+        order = np.argsort(ids, kind='stable')
+        sorted_ids = ids[order]
+        repeat = np.zeros(len(ids), dtype=bool)
+        repeat[1:] = sorted_ids[1:] == sorted_ids[:-1]
+
+        offsets = sorted_ids - self.start
+        byte = offsets >> 3
+        bit = (1 << (offsets & 7)).astype(np.uint8)
+        duplicate = np.empty(len(ids), dtype=bool)
+        duplicate[order] = repeat | ((self.bits[byte] & bit) != 0)
+
+        # bits landing in the same byte are OR-ed together before the byte is updated
+        starts = np.flatnonzero(np.r_[True, byte[1:] != byte[:-1]])
+        self.bits[byte[starts]] |= np.bitwise_or.reduceat(bit, starts)
+        return duplicate
+
+class VisitDates:
+    """
+    Start and end day of every visit with an id in [start, stop), in dense arrays (8 bytes per id)
+    """
+    MISSING = np.iinfo(np.int32).min
+
+    def __init__(self, start, stop):
+        self.start = start
+        self.stop = stop
+        self.start_day = np.full(stop - start, self.MISSING, dtype=np.int32)
+        self.end_day = np.full(stop - start, self.MISSING, dtype=np.int32)
+
+    def put(self, ids, start_days, end_days):
+        inside = (ids >= self.start) & (ids < self.stop)
+        offsets = ids[inside] - self.start
+        self.start_day[offsets] = start_days[inside]
+        self.end_day[offsets] = end_days[inside]
+
+    def outside(self, ids, days):
+        """
+        Boolean mask of rows whose day falls outside their visit, visits not in the window are skipped
+        """
+        result = np.zeros(len(ids), dtype=bool)
+        inside = (ids >= self.start) & (ids < self.stop)
+        offsets = ids[inside] - self.start
+        start_day, end_day = self.start_day[offsets], self.end_day[offsets]
+        known = start_day != self.MISSING
+        result[inside] = known & ((days[inside] < start_day) | (days[inside] > end_day))
+        return result
+
+def has_output(output_dir, output_format, table_name):
+    """
+    Whether a table was written, runs can generate a subset of the tables (duckdb always has every table)
+    """
+    if output_format == 'csv':
+        return bool(csv_files(output_dir, table_name))
+    if output_format == 'parquet':
+        return os.path.isdir(os.path.join(output_dir, table_name))
+    return True
+
+def read_batches(output_dir, output_format, table_name, columns, batch_size=1000000, con=None):
+    """
+    Stream columns of a generated table as Arrow record batches, typed from the DDL
+    con is an open DuckDB connection for output_format='duckdb'
+    """
+    try:
+        import pyarrow as pa  # noqa: F401
+    except ImportError:
+        raise ImportError("pyarrow is required for validation: pip install pyarrow")
+
+    if output_format == 'duckdb':
+        yield from con.execute(f"select {', '.join(columns)} from {table_name}").fetch_record_batch(batch_size)
+        return
+
+    if output_format == 'csv':
+        import pyarrow as pa
+        import pyarrow.csv as csv
+        # a single file or part files, plain or compressed (detected from the extension)
+        paths = csv_files(output_dir, table_name)
+        if not paths:
+            raise FileNotFoundError(f"no csv files for {table_name} in {output_dir}")
+        schema = arrow_schema(table_name, wide_integers=True)
+        for path in paths:
+            reader = csv.open_csv(
+                pa.input_stream(path, compression='detect'),
+                # block size in bytes, roughly batch_size rows
+                read_options=csv.ReadOptions(block_size=batch_size * 64),
+                convert_options=csv.ConvertOptions(
+                    include_columns=columns,
+                    column_types={column: schema.field(column).type for column in columns}
+                )
+            )
+            yield from reader
+        return
+    if output_format != 'parquet':
+        raise ValueError(f"unknown output format: {output_format}")
+
+    import pyarrow.dataset as ds
+    yield from ds.dataset(os.path.join(output_dir, table_name), format='parquet', partitioning='hive').to_batches(columns=columns, batch_size=batch_size)
+
+def _column(batch, name):
+    """
+    (int64 values, valid mask) of a batch column, dates as days since epoch and nulls as 0
+    """
+    import pyarrow as pa
+
+    column = batch.column(name)
+    if pa.types.is_date(column.type):
+        column = column.cast(pa.int32())
+    valid = column.is_valid().to_numpy(zero_copy_only=False) if column.null_count else np.ones(len(column), dtype=bool)
+    values = column.fill_null(0).to_numpy(zero_copy_only=False).astype(np.int64)
+    return values, valid
+
+def _record(report, table_name, rule, mask, ids):
+    """
+    Add the rows of mask to the violations of table_name / rule
+    """
+    count = int(mask.sum())
+    violation = report['violations'].setdefault(table_name, {}).setdefault(rule, {'count': 0, 'examples': []})
+    if count == 0:
+        return
+    violation['count'] += count
+    if len(violation['examples']) < MAX_EXAMPLES:
+        violation['examples'] += ids[mask][:MAX_EXAMPLES - len(violation['examples'])].tolist()
+
+def _load_visit_dates(window, read):
+    """
+    Fill window (VisitDates) from the visit_occurrence table
+    """
+    for batch in read('visit_occurrence', ['visit_occurrence_id', 'visit_start_date', 'visit_end_date']):
+        ids, valid = _column(batch, 'visit_occurrence_id')
+        start_days, start_valid = _column(batch, 'visit_start_date')
+        end_days, end_valid = _column(batch, 'visit_end_date')
+        keep = valid & start_valid & end_valid
+        window.put(ids[keep], start_days[keep], end_days[keep])
+
+def _check_event_dates(report, table_name, window, read):
+    """
+    Check the event dates of table_name against the visits in window
+    """
+    pk = load_ddl()[table_name]['primary_key']
+    date_column = EVENT_DATE_COLUMNS[table_name]
+    for batch in read(table_name, [pk, 'visit_occurrence_id', date_column]):
+        _check_batch_dates(report, table_name, batch, window, pk)
+
+def _check_batch_dates(report, table_name, batch, window, pk):
+    row_ids, _ = _column(batch, pk)
+    visit_ids, visit_valid = _column(batch, 'visit_occurrence_id')
+    days, day_valid = _column(batch, EVENT_DATE_COLUMNS[table_name])
+    outside = window.outside(visit_ids, days) & visit_valid & day_valid
+    _record(report, table_name, 'outside_visit_dates', outside, row_ids)
+
+def validate(output_dir='export', output_format='csv', batch_size=1000000, window_size=100000000, database='omop.duckdb'):
+    """
+    Validate generated output, returning {'rows': {table: rows}, 'violations': {table: {rule: {'count', 'examples'}}}}
+    Rules: not_null <column>, primary_key, foreign_key <column>, end_before_start (visits, drugs)
+    and outside_visit_dates (event date outside its visit's start and end date)
+    Tables that were not generated are skipped
+    window_size caps the visit ids whose dates are held in memory at once (8 bytes each), larger
+    datasets take one extra read of the event date columns per additional window
+    database is the duckdb file in output_dir (the database option of DuckDbSink)
+    """
+    con = None
+    if output_format == 'duckdb':
+        import duckdb
+        database_path = os.path.join(output_dir, database)
+        if not os.path.exists(database_path):
+            raise FileNotFoundError(f"no duckdb database at {database_path}")
+        con = duckdb.connect(database_path, read_only=True)
+
+    def read(table_name, columns):
+        return read_batches(output_dir, output_format, table_name, columns, batch_size, con)
+
+    ddl = load_ddl()
+    referenced = {ref_table for table in ddl.values() for ref_table, _ in table['foreign_keys'].values()}
+    report = {'rows': {}, 'violations': {}}
+    bitmaps = {}
+    window = None
+
+    try:
+        # referenced tables come first in TABLE_COLUMNS, so their bitmaps are complete when checked against
+        tables = [table_name for table_name in TABLE_COLUMNS if has_output(output_dir, output_format, table_name)]
+        for table_name in tables:
+            table = ddl[table_name]
+            pk = table['primary_key']
+            not_null = [column for column, (_, is_not_null) in table['columns'].items() if is_not_null]
+            columns = list(dict.fromkeys(
+                [pk] + not_null + list(table['foreign_keys'])
+                + list(DATE_ORDER_COLUMNS.get(table_name, ()))
+                + ([EVENT_DATE_COLUMNS[table_name]] if table_name in EVENT_DATE_COLUMNS else [])
+            ))
+
+            # visit dates of the first window are checked in the same read as the other rules
+            if table_name in EVENT_DATE_COLUMNS and window is None and 'visit_occurrence' in bitmaps:
+                visits = bitmaps['visit_occurrence']
+                if visits.min_id is not None:
+                    window = VisitDates(visits.min_id, min(visits.min_id + window_size, visits.max_id + 1))
+                    _load_visit_dates(window, read)
+
+            bitmap = IdBitmap()
+            rows = 0
+            for batch in read(table_name, columns):
+                rows += batch.num_rows
+                row_ids, pk_valid = _column(batch, pk)
+
+                for column in not_null:
+                    nulls = ~_column(batch, column)[1] if batch.column(column).null_count else np.zeros(len(row_ids), dtype=bool)
+                    _record(report, table_name, f"not_null {column}", nulls, row_ids)
+
+                duplicate = np.zeros(len(row_ids), dtype=bool)
+                duplicate[pk_valid] = bitmap.add(row_ids[pk_valid])
+                _record(report, table_name, 'primary_key', duplicate, row_ids)
+
+                for column, (ref_table, _) in table['foreign_keys'].items():
+                    ids, valid = _column(batch, column)
+                    # a missing referenced table leaves every reference dangling
+                    missing = ~bitmaps[ref_table].contains(ids) if ref_table in bitmaps else np.ones(len(ids), dtype=bool)
+                    _record(report, table_name, f"foreign_key {column}", valid & missing, row_ids)
+
+                if table_name in DATE_ORDER_COLUMNS:
+                    start_column, end_column = DATE_ORDER_COLUMNS[table_name]
+                    start_days, start_valid = _column(batch, start_column)
+                    end_days, end_valid = _column(batch, end_column)
+                    _record(report, table_name, 'end_before_start', start_valid & end_valid & (end_days < start_days), row_ids)
+
+                if window is not None and table_name in EVENT_DATE_COLUMNS:
+                    _check_batch_dates(report, table_name, batch, window, pk)
+
+            report['rows'][table_name] = rows
+            if table_name in referenced:
+                bitmaps[table_name] = bitmap
+
+        # visits beyond the first window, one window of visit dates at a time
+        visits = bitmaps.get('visit_occurrence')
+        while window is not None and window.stop <= visits.max_id:
+            window = VisitDates(window.stop, min(window.stop + window_size, visits.max_id + 1))
+            _load_visit_dates(window, read)
+            for table_name in [table_name for table_name in tables if table_name in EVENT_DATE_COLUMNS]:
+                _check_event_dates(report, table_name, window, read)
+    finally:
+        if con is not None:
+            con.close()
+
+    return report
+
+def violation_count(report):
+    return sum(v['count'] for rules in report['violations'].values() for v in rules.values())
+
+def format_report(report):
+    """
+    Plain text report, row counts then one line per table and rule
+    """
+    lines = [f"{table_name}: {rows} rows" for table_name, rows in report['rows'].items()]
+    for table_name, rules in report['violations'].items():
+        for rule, violation in rules.items():
+            status = 'ok' if violation['count'] == 0 else f"{violation['count']} violations, e.g. ids {violation['examples']}"
+            lines.append(f"{table_name} {rule}: {status}")
+    return '\n'.join(lines)
@@ -0,0 +1,30 @@
+import argparse
+import json
+import sys
+
+from src.validate import validate, format_report, violation_count
+
+# python validate_omop.py                      (CSV output in export/)
+# python validate_omop.py --format parquet --report validation.json
+# python validate_omop.py --format duckdb --database cohort.duckdb
+
+parser = argparse.ArgumentParser(description="Check primary keys, foreign keys, not null columns and event dates of generated OMOP output")
+parser.add_argument('--dir', default='export', help="output directory")
+parser.add_argument('--format', default='csv', help="output format (csv, parquet, duckdb)")
+parser.add_argument('--database', default='omop.duckdb', help="duckdb database file in the output directory")
+parser.add_argument('--batch-size', type=int, default=1000000, help="rows read per batch")
+parser.add_argument('--window-size', type=int, default=100000000, help="visit ids whose dates are held in memory at once (8 bytes each)")
+parser.add_argument('--report', help="also write the report to this file (JSON)")
+args = parser.parse_args()
+
+report = validate(args.dir, args.format, args.batch_size, args.window_size, args.database)
+print(format_report(report))
+if args.report:
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+
+n_violations = violation_count(report)
+if n_violations:
+    print(f"{n_violations} constraint violations.")
+    sys.exit(1)
+print("no constraint violations.")
@@ -117,12 +117,12 @@ create or replace table measurement (
     meas_event_field_concept_id integer
 );
 
--- load from CSVs
-copy person from 'export/person.csv' (AUTO_DETECT true);
-copy visit_occurrence from 'export/visit_occurrence.csv' (AUTO_DETECT true);
-copy condition_occurrence from 'export/condition_occurrence.csv' (AUTO_DETECT true);
-copy drug_exposure from 'export/drug_exposure.csv' (AUTO_DETECT true);
-copy measurement from 'export/measurement.csv' (AUTO_DETECT true);
+-- load from CSVs, the globs match a single file or part files (<table>-000.csv ...), plain or compressed
+copy person from 'export/person*.csv*' (AUTO_DETECT true);
+copy visit_occurrence from 'export/visit_occurrence*.csv*' (AUTO_DETECT true);
+copy condition_occurrence from 'export/condition_occurrence*.csv*' (AUTO_DETECT true);
+copy drug_exposure from 'export/drug_exposure*.csv*' (AUTO_DETECT true);
+copy measurement from 'export/measurement*.csv*' (AUTO_DETECT true);
 
 -- row counts
 select 